@@ -0,0 +1,406 @@
+# Load-testing and benchmark harness for the BreakBetter API.
+#
+# Runs the FastAPI app in its own process against an offline stand-in for
+# MongoDB (mongomock, or a local mongod via --mongodb-url) and a fake OpenAI
+# server with configurable latency and token rate, then drives a realistic
+# mix of requests at a fixed concurrency and reports per-endpoint latency
+# percentiles and throughput. No network access is needed.
+#
+# Usage (from the backend directory):
+#   pip install -r requirements-dev.txt
+#   python benchmark.py --concurrency 50 --duration 30 --llm-latency 1.5
+#   python benchmark.py --mix recommend=5,stats=3,history=2 --json results.json
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+
+# Default request mix (relative weights)
+DEFAULT_MIX = {
+    "login": 1,
+    "recommend": 4,
+    "session_start": 2,
+    "session_end": 2,
+    "break_start": 2,
+    "break_end": 2,
+    "stats": 3,
+    "history": 2,
+}
+
+PREFERENCES = ["walking", "music", "reading", "meditation", "exercise", "tea", "drawing", "gaming"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ---------------------------------------------------------------------------
+# Fake OpenAI server
+# ---------------------------------------------------------------------------
+
+def run_fake_openai(port: int, latency: float, token_rate: float, completion_tokens: int):
+    import uvicorn
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    words = "Take a brisk walk outside and stretch your legs before the next focused session".split()
+
+    # A JSON reply like the app asks for, padded to about `completion_tokens` words
+    def completion_text():
+        description = " ".join(words[i % len(words)] for i in range(max(1, completion_tokens - 20)))
+        return json.dumps({
+            "break_activity": "Take a brisk walk outside",
+            "description": description,
+            "benefits": ["Improved focus", "Better mood", "Less eye strain"],
+            "study_tips": ["Silence notifications", "Set one goal", "Keep water nearby"],
+        })
+
+    # Used by the app's startup warm-up to open a keep-alive connection
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model", "created": 0, "owned_by": "bench"}]}
+
+    # Time to first token is `latency`; the rest arrives at `token_rate` tokens/s
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        created = int(time.time())
+        await asyncio.sleep(latency)
+
+        if body.get("stream"):
+            async def events():
+                for i, word in enumerate(completion_text().split(" ")):
+                    token = ("" if i == 0 else " ") + word
+                    chunk = {
+                        "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created,
+                        "model": body.get("model", "gpt-3.5-turbo"),
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    if token_rate > 0:
+                        await asyncio.sleep(1 / token_rate)
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        if token_rate > 0:
+            await asyncio.sleep(completion_tokens / token_rate)
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        return {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": created,
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": completion_text()},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+# ---------------------------------------------------------------------------
+# Application under test
+# ---------------------------------------------------------------------------
+
+def run_app(port: int, openai_url: str, mongodb_url: str, env: dict):
+    os.environ.update(env)
+    os.environ["OPENAI_BASE_URL"] = openai_url
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    if mongodb_url:
+        os.environ["MONGODB_URL"] = mongodb_url
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import uvicorn
+    import main
+
+    # Per-request INFO logging would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("main").setLevel(logging.WARNING)
+
+    if not mongodb_url:
+        from mongomock_motor import AsyncMongoMockClient
+        main.create_mongo_client = AsyncMongoMockClient
+
+        # mongomock ignores partialFilterExpression, so the unique
+        # (user_id, client_id) ingest index would reject every session a
+        # user starts without a client_id after their first
+        async def ensure_ingest_indexes(db):
+            from pymongo import ASCENDING, IndexModel
+            index = IndexModel([("user_id", ASCENDING), ("client_id", ASCENDING)])
+            await db.study_sessions.create_indexes([index])
+            await db.break_sessions.create_indexes([index])
+        main.ingest.ensure_indexes = ensure_ingest_indexes
+
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(url)
+                if response.status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+# ---------------------------------------------------------------------------
+# Load generator
+# ---------------------------------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint: str, seconds: float, status_code: int):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status_code] += 1
+        if status_code >= 400:
+            self.errors[endpoint] += 1
+
+    def report(self, elapsed: float) -> dict:
+        results = {}
+        for endpoint, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            quantiles = statistics.quantiles(ordered, n=100, method="inclusive") if len(ordered) > 1 else ordered * 99
+            results[endpoint] = {
+                "requests": len(ordered),
+                "errors": self.errors[endpoint],
+                "rps": len(ordered) / elapsed,
+                "p50_ms": quantiles[49] * 1000,
+                "p95_ms": quantiles[94] * 1000,
+                "p99_ms": quantiles[98] * 1000,
+                "max_ms": ordered[-1] * 1000,
+                "status_codes": dict(self.statuses[endpoint]),
+            }
+        total = sum(len(s) for s in self.latencies.values())
+        results["_total"] = {"requests": total, "rps": total / elapsed, "elapsed_s": elapsed}
+        return results
+
+
+def random_profile(rng: random.Random, profile_space: int) -> dict:
+    # profile_space controls how many distinct profiles exist (cache hit rate)
+    seed = rng.randrange(profile_space)
+    prng = random.Random(seed)
+    return {
+        "name": f"bench-{seed}",
+        "study_interval": prng.choice(["high_mental", "low_mental"]),
+        "time_of_day": prng.choice(["morning", "evening"]),
+        "deadline_pressure": prng.choice(["high", "low"]),
+        "personal_preferences": ", ".join(prng.sample(PREFERENCES, 2)),
+        "screen_usage": prng.random() < 0.7,
+        "activity_level": prng.choice(["sedentary", "active"]),
+        "energy_level": prng.randint(1, 10),
+        "preferred_break_duration": prng.choice([5, 10, 15, 20]),
+    }
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, username: str, password: str, rng: random.Random, args):
+        self.client = client
+        self.username = username
+        self.password = password
+        self.rng = rng
+        self.args = args
+        self.headers = {}
+        self.open_sessions = []
+        self.open_breaks = []
+
+    async def call(self, recorder: Recorder, endpoint: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            status_code = response.status_code
+        except httpx.HTTPError:
+            response, status_code = None, 599
+        recorder.record(endpoint, time.perf_counter() - started, status_code)
+        return response
+
+    async def login(self, recorder: Recorder):
+        response = await self.call(
+            recorder, "login", "POST", "/token",
+            data={"username": self.username, "password": self.password}
+        )
+        if response is not None and response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def step(self, recorder: Recorder, operation: str):
+        if operation == "login":
+            await self.login(recorder)
+        elif operation == "recommend":
+            await self.call(
+                recorder, "recommend", "POST", "/api/recommend",
+                json=random_profile(self.rng, self.args.profile_space), headers=self.headers
+            )
+        elif operation == "session_start":
+            response = await self.call(recorder, "session_start", "POST", "/api/sessions/start", headers=self.headers)
+            if response is not None and response.status_code == 200:
+                self.open_sessions.append(response.json()["session_id"])
+        elif operation == "session_end" and self.open_sessions:
+            session_id = self.open_sessions.pop(0)
+            await self.call(recorder, "session_end", "POST", f"/api/sessions/{session_id}/end", headers=self.headers)
+        elif operation == "break_start":
+            response = await self.call(
+                recorder, "break_start", "POST", "/api/breaks/start",
+                params={"energy_level": self.rng.randint(1, 10)}, headers=self.headers
+            )
+            if response is not None and response.status_code == 200:
+                self.open_breaks.append(response.json()["break_id"])
+        elif operation == "break_end" and self.open_breaks:
+            break_id = self.open_breaks.pop(0)
+            await self.call(
+                recorder, "break_end", "POST", f"/api/breaks/{break_id}/end",
+                params={"energy_level": self.rng.randint(1, 10)}, headers=self.headers
+            )
+        elif operation == "stats":
+            await self.call(
+                recorder, "stats", "GET", "/api/stats",
+                params={"days": self.rng.choice([7, 30, 365])}, headers=self.headers
+            )
+        elif operation == "history":
+            await self.call(recorder, "history", "GET", "/api/history", headers=self.headers)
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{name}', expected one of {sorted(DEFAULT_MIX)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+async def drive(base_url: str, args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.request_timeout, limits=limits) as client:
+        # Register and log in one account per virtual user (not measured)
+        users = []
+        setup = Recorder()
+        for i in range(args.concurrency):
+            username, password = f"bench{i}", "benchmark-password"
+            await client.post("/register", json={
+                "username": username, "email": f"{username}@example.com", "password": password
+            })
+            user = VirtualUser(client, username, password, random.Random(args.seed + i), args)
+            await user.login(setup)
+            users.append(user)
+
+        operations = list(args.mix)
+        weights = [args.mix[op] for op in operations]
+        recorder = Recorder()
+        stop_at = time.monotonic() + args.duration
+
+        async def run_user(user: VirtualUser):
+            while time.monotonic() < stop_at:
+                await user.step(recorder, user.rng.choices(operations, weights)[0])
+                if args.think_time:
+                    await asyncio.sleep(user.rng.expovariate(1 / args.think_time))
+
+        started = time.monotonic()
+        await asyncio.gather(*(run_user(user) for user in users))
+        return recorder.report(time.monotonic() - started)
+
+
+def print_report(results: dict):
+    header = f"{'endpoint':<15}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, row in results.items():
+        if endpoint == "_total":
+            continue
+        print(
+            f"{endpoint:<15}{row['requests']:>10}{row['errors']:>8}{row['rps']:>10.1f}"
+            f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}"
+        )
+    total = results["_total"]
+    print("-" * len(header))
+    print(f"{'total':<15}{total['requests']:>10}{'':>8}{total['rps']:>10.1f}   over {total['elapsed_s']:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BreakBetter API offline")
+    parser.add_argument("--concurrency", type=int, default=20, help="number of virtual users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of measured load")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="e.g. recommend=4,stats=3,history=2")
+    parser.add_argument("--think-time", type=float, default=0, help="mean pause between a user's requests (s)")
+    parser.add_argument("--profile-space", type=int, default=200, help="number of distinct recommendation profiles")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="fake OpenAI time to first token (s)")
+    parser.add_argument("--token-rate", type=float, default=100, help="fake OpenAI tokens per second (0 = instant)")
+    parser.add_argument("--completion-tokens", type=int, default=60, help="tokens per fake completion")
+    parser.add_argument("--mongodb-url", default=None, help="use a local mongod instead of the in-memory stand-in")
+    parser.add_argument("--bcrypt-rounds", type=int, default=None, help="override BCRYPT_ROUNDS for the app")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the app's admission rate limits (off by default)")
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", help="also write results to this file")
+    args = parser.parse_args()
+
+    app_env = {}
+    if args.bcrypt_rounds:
+        app_env["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    if not args.rate_limits:
+        # Virtual users without think time would mostly measure 429s
+        app_env.update({
+            "RATE_LIMIT_USER_PER_MINUTE": "1000000", "RATE_LIMIT_USER_BURST": "1000000",
+            "RATE_LIMIT_GLOBAL_PER_SECOND": "1000000", "RATE_LIMIT_GLOBAL_BURST": "1000000",
+        })
+
+    openai_port, app_port = free_port(), free_port()
+    openai_url = f"http://127.0.0.1:{openai_port}/v1"
+    app_url = f"http://127.0.0.1:{app_port}"
+
+    processes = [
+        multiprocessing.Process(
+            target=run_fake_openai,
+            args=(openai_port, args.llm_latency, args.token_rate, args.completion_tokens),
+            daemon=False
+        ),
+        multiprocessing.Process(
+            target=run_app,
+            args=(app_port, openai_url, args.mongodb_url, app_env),
+            daemon=False
+        ),
+    ]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(wait_until_up(app_url + "/ready"))
+        results = asyncio.run(drive(app_url, args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "json_path"}, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+# Optional time-bucketed session storage. With SESSION_BUCKETS=true a
+# background compactor moves completed sessions older than
+# SESSION_COMPACT_AFTER_DAYS out of study_sessions/break_sessions into one
+# session_buckets document per user, kind and day (or week) holding the
+# sessions and per-day summaries. Buckets older than
+# SESSION_ARCHIVE_AFTER_DAYS are written to gzipped BSON files under
+# SESSION_ARCHIVE_DIR and only their summaries stay in MongoDB.
+#
+# Readers (stats, export, ingest, personalization) use the helpers here
+# alongside their raw queries, so raw, bucketed and archived sessions look
+# the same to them. Stats, export and ingest skip the bucket queries while
+# no buckets are in use (see reads_enabled).
+import asyncio
+import gzip
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import bson
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+SESSION_BUCKETS = os.getenv("SESSION_BUCKETS", "false").lower() == "true"
+SESSION_BUCKET_UNIT = os.getenv("SESSION_BUCKET_UNIT", "day")  # "day" or "week"
+SESSION_COMPACT_AFTER_DAYS = int(os.getenv("SESSION_COMPACT_AFTER_DAYS", "7"))
+SESSION_COMPACT_INTERVAL_SECONDS = float(os.getenv("SESSION_COMPACT_INTERVAL_SECONDS", "3600"))
+SESSION_COMPACT_BATCH_SIZE = int(os.getenv("SESSION_COMPACT_BATCH_SIZE", "1000"))
+# 0 keeps every bucket in MongoDB
+SESSION_ARCHIVE_AFTER_DAYS = int(os.getenv("SESSION_ARCHIVE_AFTER_DAYS", "180"))
+SESSION_ARCHIVE_DIR = os.getenv("SESSION_ARCHIVE_DIR", "session_archive")
+
+# Whether readers look at buckets at all: the mode is on, or buckets are
+# left over from when it was. Set at startup by detect().
+reads_enabled = SESSION_BUCKETS
+
+BUCKET_DAYS = {"day": 1, "week": 7}
+ONE_DAY = timedelta(days=1)
+# How far before a window's start a bucket overlapping it can begin
+MAX_BUCKET_SPAN = timedelta(days=max(BUCKET_DAYS.values()))
+
+
+async def ensure_indexes(db):
+    await db.session_buckets.create_indexes([
+        IndexModel([("user_id", ASCENDING), ("kind", ASCENDING), ("start", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("clients.client_id", ASCENDING)]),
+        IndexModel([("archived", ASCENDING), ("end", ASCENDING)]),
+    ])
+
+
+async def detect(db):
+    global reads_enabled
+    reads_enabled = SESSION_BUCKETS or await db.session_buckets.find_one({}, {"_id": 1}) is not None
+
+
+def _collection(db, kind: str):
+    return db.study_sessions if kind == "study" else db.break_sessions
+
+
+# Buckets are keyed on the UTC day (or the Monday of the week) sessions started
+def bucket_start(moment: datetime, unit: str = SESSION_BUCKET_UNIT) -> datetime:
+    start = datetime(moment.year, moment.month, moment.day)
+    if unit == "week":
+        start -= timedelta(days=start.weekday())
+    return start
+
+
+def _minutes(session: dict) -> float:
+    return (session["end_time"] - session["start_time"]).total_seconds() / 60
+
+
+# Totals for completed sessions, shaped like stats' raw aggregations
+def summarize(kind: str, sessions: list) -> dict:
+    if kind == "study":
+        return {
+            "study_minutes": sum(_minutes(session) for session in sessions),
+            "study_sessions": len(sessions)
+        }
+    totals = {
+        "break_minutes": 0, "break_sessions": 0,
+        "energy_change_total": 0, "energy_change_count": 0,
+        "activities": {}
+    }
+    for session in sessions:
+        totals["break_minutes"] += _minutes(session)
+        totals["break_sessions"] += 1
+        after, before = session.get("energy_level_after"), session.get("energy_level_before")
+        if after is not None:
+            totals["energy_change_count"] += 1
+            if before is not None:
+                totals["energy_change_total"] += after - before
+        activity = session.get("activity")
+        totals["activities"][activity] = totals["activities"].get(activity, 0) + 1
+    return totals
+
+
+# Per-day summaries stored on a bucket. Activity names are arbitrary, so
+# they are stored as a list rather than as field names.
+def _day_summaries(kind: str, sessions: list) -> list:
+    days = {}
+    for session in sessions:
+        days.setdefault(bucket_start(session["start_time"], "day"), []).append(session)
+    summaries = []
+    for day, day_sessions in sorted(days.items()):
+        summary = summarize(kind, day_sessions)
+        if "activities" in summary:
+            summary["activities"] = [
+                {"activity": activity, "count": count} for activity, count in summary["activities"].items()
+            ]
+        summaries.append({"day": day, **summary})
+    return summaries
+
+
+# A stored day summary in the shape summarize() returns
+def day_totals(summary: dict) -> dict:
+    totals = {key: value for key, value in summary.items() if key != "day"}
+    if "activities" in totals:
+        totals["activities"] = {item["activity"]: item["count"] for item in totals["activities"]}
+    return totals
+
+
+def _bucket_document(user_id: str, kind: str, unit: str, start: datetime, sessions: list) -> dict:
+    sessions.sort(key=lambda session: session["start_time"])
+    return {
+        "user_id": user_id,
+        "kind": kind,
+        "unit": unit,
+        "start": start,
+        "end": start + timedelta(days=BUCKET_DAYS[unit]),
+        "count": len(sessions),
+        "days": _day_summaries(kind, sessions),
+        # Lets ingest recognise replayed events for sessions moved here
+        "clients": [
+            {"client_id": session["client_id"], "_id": session["_id"]}
+            for session in sessions if session.get("client_id")
+        ],
+        "sessions": sessions,
+        "archived": False,
+    }
+
+
+def _archive_path(bucket: dict) -> str:
+    return os.path.join(bucket["kind"], f"{bucket['start']:%Y-%m}", f"{bucket['_id']}.bson.gz")
+
+
+def _write_archive(path: str, sessions: list):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path + ".tmp", "wb") as f:
+        f.write(bson.encode({"sessions": sessions}))
+    os.replace(path + ".tmp", path)
+
+
+def _read_archive(path: str) -> list:
+    with gzip.open(path, "rb") as f:
+        return bson.decode(f.read())["sessions"]
+
+
+# The sessions of a bucket, read from its archive file once it is archived
+async def bucket_sessions(bucket: dict, archive_dir: str = SESSION_ARCHIVE_DIR) -> list:
+    if bucket.get("archived"):
+        return await asyncio.to_thread(_read_archive, os.path.join(archive_dir, bucket["archive_path"]))
+    return bucket["sessions"]
+
+
+# Totals for a user's bucketed sessions of one kind that started in
+# [start, end). Days inside the window come from the day summaries; only
+# the sessions of a partially covered first or last day are read.
+async def aggregate_totals(db, user_id: str, kind: str, start: datetime, end: datetime = None) -> dict:
+    bucket_range = {"$gt": start - MAX_BUCKET_SPAN}
+    if end is not None:
+        bucket_range["$lt"] = end
+    parts = []
+    partial = []
+    async for bucket in db.session_buckets.find(
+        {"user_id": user_id, "kind": kind, "start": bucket_range},
+        {"sessions": 0, "clients": 0}
+    ):
+        for summary in bucket["days"]:
+            day = summary["day"]
+            if day + ONE_DAY <= start or (end is not None and day >= end):
+                continue
+            if day >= start and (end is None or day + ONE_DAY <= end):
+                parts.append(day_totals(summary))
+            elif bucket["_id"] not in partial:
+                partial.append(bucket["_id"])
+
+    sessions = []
+    if partial:
+        async for bucket in db.session_buckets.find({"_id": {"$in": partial}}, {"days": 0, "clients": 0}):
+            sessions.extend(
+                session for session in await bucket_sessions(bucket)
+                if session["start_time"] >= start and (end is None or session["start_time"] < end)
+            )
+    parts.append(summarize(kind, sessions))
+
+    totals = {"activities": {}}
+    for part in parts:
+        for key, value in part.items():
+            if key == "activities":
+                for activity, count in value.items():
+                    totals["activities"][activity] = totals["activities"].get(activity, 0) + count
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+# A user's bucketed sessions of one kind in start_time order, optionally
+# only those that started at or after `since`
+async def iter_sessions(db, user_id: str, kind: str, since: datetime = None):
+    query = {"user_id": user_id, "kind": kind}
+    if since is not None:
+        query["start"] = {"$gt": since - MAX_BUCKET_SPAN}
+    cursor = db.session_buckets.find(query, {"days": 0, "clients": 0}).sort("start", ASCENDING)
+    async for bucket in cursor:
+        for session in await bucket_sessions(bucket):
+            if since is None or session["start_time"] >= since:
+                session["user_id"] = user_id
+                yield session
+
+
+async def _next(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+# Merge two async iterables of sessions, each sorted by start_time (raw
+# sessions left behind in already archived buckets can predate bucketed ones)
+async def merge_sessions(first, second):
+    first, second = first.__aiter__(), second.__aiter__()
+    a, b = await _next(first), await _next(second)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a["start_time"] <= b["start_time"]):
+            yield a
+            a = await _next(first)
+        else:
+            yield b
+            b = await _next(second)
+
+
+# Bucketed sessions of one kind with the given client ids, keyed by
+# client_id. Archived sessions come back as stubs (_id and completed=True),
+# which is all ingest needs to treat replayed events as duplicates.
+async def find_client_sessions(db, user_id: str, kind: str, client_ids) -> dict:
+    client_ids = set(client_ids)
+    found = {}
+    async for bucket in db.session_buckets.find(
+        {"user_id": user_id, "clients.client_id": {"$in": list(client_ids)}, "kind": kind},
+        {"days": 0}
+    ):
+        sessions = {session["_id"]: session for session in bucket.get("sessions", [])}
+        for client in bucket["clients"]:
+            if client["client_id"] in client_ids:
+                found[client["client_id"]] = sessions.get(client["_id"]) or {
+                    "_id": client["_id"], "client_id": client["client_id"], "completed": True
+                }
+    return found
+
+
+# Take the named lease for `seconds` unless another worker holds it, so only
+# one worker compacts at a time
+async def acquire_lease(db, name: str, seconds: float) -> bool:
+    now = datetime.utcnow()
+    try:
+        await db.leases.update_one(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {"expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+# Move completed raw sessions that started before the compaction cutoff
+# into their buckets. Buckets are written before the raw documents are
+# deleted and are merged by _id, so an interrupted run is finished by the
+# next one. Returns the number of sessions moved.
+async def compact(db, now: datetime = None, unit: str = SESSION_BUCKET_UNIT,
+                  batch_size: int = SESSION_COMPACT_BATCH_SIZE) -> int:
+    now = now or datetime.utcnow()
+    cutoff = bucket_start(now - timedelta(days=SESSION_COMPACT_AFTER_DAYS), unit)
+    moved = 0
+    for kind in ("study", "break"):
+        # Walks the (user_id, completed, start_time) stats index backwards,
+        # so each bucket's sessions arrive together
+        cursor = _collection(db, kind).find(
+            {"completed": True, "start_time": {"$lt": cutoff}}
+        ).sort([
+            ("user_id", DESCENDING), ("completed", DESCENDING), ("start_time", ASCENDING)
+        ]).batch_size(batch_size)
+        groups = {}
+        count = 0
+        async for session in cursor:
+            key = (session["user_id"], bucket_start(session["start_time"], unit))
+            if count >= batch_size and key not in groups:
+                moved += await _compact_groups(db, kind, unit, groups)
+                groups = {}
+                count = 0
+            groups.setdefault(key, []).append(session)
+            count += 1
+        moved += await _compact_groups(db, kind, unit, groups)
+    return moved
+
+
+async def _compact_groups(db, kind: str, unit: str, groups: dict) -> int:
+    if not groups:
+        return 0
+    existing = {}
+    async for bucket in db.session_buckets.find({"$or": [
+        {"user_id": user_id, "kind": kind, "start": start} for user_id, start in groups
+    ]}):
+        existing[(bucket["user_id"], bucket["start"])] = bucket
+
+    writes = []
+    moved_ids = []
+    for (user_id, start), sessions in groups.items():
+        bucket = existing.get((user_id, start))
+        if bucket is not None and bucket["archived"]:
+            # Late-completed sessions of an archived bucket stay raw
+            continue
+        merged = {session["_id"]: session for session in (bucket or {}).get("sessions", [])}
+        for session in sessions:
+            merged[session["_id"]] = {key: value for key, value in session.items() if key != "user_id"}
+        writes.append(ReplaceOne(
+            {"user_id": user_id, "kind": kind, "start": start},
+            _bucket_document(user_id, kind, unit, start, list(merged.values())),
+            upsert=True
+        ))
+        moved_ids.extend(session["_id"] for session in sessions)
+
+    if writes:
+        await db.session_buckets.bulk_write(writes, ordered=False)
+        await _collection(db, kind).delete_many({"_id": {"$in": moved_ids}})
+    return len(moved_ids)
+
+
+# Write buckets that ended more than SESSION_ARCHIVE_AFTER_DAYS ago to
+# compressed files and drop their sessions from MongoDB, keeping the
+# summaries. Returns the number of buckets archived.
+async def archive(db, now: datetime = None, archive_dir: str = SESSION_ARCHIVE_DIR) -> int:
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=SESSION_ARCHIVE_AFTER_DAYS)
+    buckets = await db.session_buckets.find(
+        {"archived": False, "end": {"$lte": cutoff}}, {"_id": 1}
+    ).to_list(length=None)
+    archived = 0
+    for bucket_id in (bucket["_id"] for bucket in buckets):
+        bucket = await db.session_buckets.find_one({"_id": bucket_id, "archived": False})
+        if bucket is None:
+            continue
+        path = _archive_path(bucket)
+        await asyncio.to_thread(_write_archive, os.path.join(archive_dir, path), bucket["sessions"])
+        await db.session_buckets.update_one(
+            {"_id": bucket_id, "archived": False},
+            {"$set": {"archived": True, "archive_path": path}, "$unset": {"sessions": ""}}
+        )
+        archived += 1
+    return archived
+
+
+# One compaction (and archive) pass
+async def run_once(db):
+    started = time.perf_counter()
+    moved = await compact(db)
+    archived = await archive(db) if SESSION_ARCHIVE_AFTER_DAYS else 0
+    logger.info(
+        f"Compacted {moved} sessions and archived {archived} buckets "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+
+# Background compactor; every worker runs it but the lease lets only one
+# of them do the work each interval
+async def compact_periodically(db, interval: float = SESSION_COMPACT_INTERVAL_SECONDS):
+    while True:
+        try:
+            if await acquire_lease(db, "session_compactor", interval):
+                await run_once(db)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error compacting sessions: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+# Run one compaction pass from the command line: python buckets.py
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv("MONGODB_URL"))
+    asyncio.run(run_once(client.breakbetter))
@@ -0,0 +1,151 @@
+# In-process caching helpers shared by the BreakBetter API
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Simple TTL + LRU cache. Entries expire after `ttl` seconds and the least
+# recently used entry is evicted once `maxsize` is reached.
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Optional cache tier shared by every worker process on the same host.
+# Values are JSON-encoded rows in a small SQLite file.
+class SharedCacheBackend:
+    def __init__(self, path: str, ttl: float = 300):
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl)
+            )
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+    # SQLite calls are blocking, so run them off the event loop
+    async def get(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key, value):
+        await asyncio.to_thread(self._set, key, value)
+
+
+# Two-tier cache (local LRU, then optional shared backend) with single-flight
+# coalescing: concurrent misses for the same key share one computation.
+class CoalescingCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, shared_path: str = None):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.shared = SharedCacheBackend(shared_path, ttl=ttl) if shared_path else None
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_compute(self, key, compute):
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        # Shield so one caller disconnecting doesn't cancel the shared work
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        self._inflight.pop(key, None)
+        # Mark failures as retrieved even if every waiter has gone away
+        if not task.cancelled():
+            task.exception()
+
+    async def _load(self, key, compute):
+        if self.shared is not None:
+            try:
+                value = await self.shared.get(key)
+            except Exception as e:
+                logger.warning(f"Shared cache read failed: {str(e)}")
+                value = None
+            if value is not None:
+                self.hits += 1
+                self.local.set(key, value)
+                return value
+
+        self.misses += 1
+        value = await compute()
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                await self.shared.set(key, value)
+            except Exception as e:
+                logger.warning(f"Shared cache write failed: {str(e)}")
+        return value
+
+    def invalidate(self, key):
+        self.local.pop(key)
+
+    def clear(self):
+        self.local.clear()
+
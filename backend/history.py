@@ -0,0 +1,133 @@
+# Recommendation history and session export helpers: keyset (cursor)
+# pagination with field projection, and constant-memory streaming export
+import base64
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+import buckets
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+# Fields clients may ask for on /api/history
+HISTORY_FIELDS = {
+    "timestamp", "study_interval", "break_activity", "duration",
+    "description", "benefits", "study_tips", "source", "profile",
+}
+DEFAULT_HISTORY_FIELDS = [
+    "timestamp", "study_interval", "break_activity", "duration", "description",
+    "benefits", "study_tips", "source",
+]
+
+# Columns written for each session kind on export
+EXPORT_COLUMNS = {
+    "study": ["id", "start_time", "end_time", "completed", "study_interval", "break_activity", "duration", "notes"],
+    "break": ["id", "start_time", "end_time", "completed", "activity", "duration", "energy_level_before", "energy_level_after"],
+}
+
+
+async def ensure_indexes(db):
+    await db.recommendations.create_indexes([
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)])
+    ])
+
+
+# Opaque cursor encoding the (timestamp, _id) of the last item on a page
+def encode_cursor(doc: dict) -> str:
+    raw = json.dumps({"t": doc["timestamp"].isoformat(), "id": str(doc["_id"])})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(raw["t"]), ObjectId(raw["id"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def parse_fields(fields: str = None) -> list:
+    if not fields:
+        return DEFAULT_HISTORY_FIELDS
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = set(requested) - HISTORY_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested
+
+
+# One page of a user's recommendation history, newest first. Returns the
+# items and a cursor for the next page (None on the last page).
+async def get_history_page(db, user_id: str, limit: int, cursor: str = None, fields: list = None):
+    query = {"user_id": user_id}
+    if cursor:
+        timestamp, last_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": last_id}},
+        ]
+    projection = {field: 1 for field in (fields or DEFAULT_HISTORY_FIELDS)}
+    projection["timestamp"] = 1
+
+    # Fetch one extra document to know whether another page exists
+    docs = await db.recommendations.find(query, projection).sort(
+        [("timestamp", DESCENDING), ("_id", DESCENDING)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    items = []
+    for doc in docs[:limit]:
+        doc["id"] = str(doc.pop("_id"))
+        items.append(doc)
+    return items, next_cursor
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+# Stream a user's sessions as NDJSON or CSV, one Motor batch at a time, so
+# memory use stays flat no matter how many sessions the user has. Raw and
+# bucketed sessions are merged in start_time order.
+async def export_sessions(db, user_id: str, kind: str, fmt: str, since: datetime = None):
+    collection = db.study_sessions if kind == "study" else db.break_sessions
+    columns = EXPORT_COLUMNS[kind]
+
+    # The $in over both values of `completed` lets MongoDB merge-sort on the
+    # (user_id, completed, start_time) index instead of sorting in memory
+    query = {"user_id": user_id, "completed": {"$in": [True, False]}}
+    if since is not None:
+        query["start_time"] = {"$gte": since}
+    cursor = collection.find(query).sort("start_time", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+    sessions = cursor
+    if buckets.reads_enabled:
+        sessions = buckets.merge_sessions(buckets.iter_sessions(db, user_id, kind, since), cursor)
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore") if fmt == "csv" else None
+    if writer is not None:
+        writer.writeheader()
+
+    count = 0
+    async for doc in sessions:
+        doc["id"] = doc.pop("_id")
+        row = {column: _export_value(doc.get(column)) for column in columns}
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row))
+            buffer.write("\n")
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,76 @@
+# Validator-based caching for dashboard reads. Each user has a data version
+# that is bumped whenever their sessions, recommendations or profile change;
+# ETags are derived from it so unchanged polls get a 304 before any query runs.
+import gzip
+import hashlib
+import os
+
+import orjson
+from fastapi import Request, Response
+from pymongo import ReturnDocument
+
+from cache import TTLCache
+
+# How long a worker trusts its cached copy of a user's version. Bumps made by
+# this worker are seen immediately; bumps on other workers within this bound.
+USER_VERSION_TTL_SECONDS = float(os.getenv("USER_VERSION_TTL_SECONDS", "2"))
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+
+
+# Per-user data versions, stored on the user document and cached per worker
+class UserVersions:
+    def __init__(self, ttl: float = USER_VERSION_TTL_SECONDS, maxsize: int = 10000):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, db, username: str) -> int:
+        version = self.cache.get(username)
+        if version is None:
+            user = await db.users.find_one({"username": username}, {"data_version": 1})
+            version = (user or {}).get("data_version", 0)
+            self.cache.set(username, version)
+        return version
+
+    async def bump(self, db, username: str) -> int:
+        user = await db.users.find_one_and_update(
+            {"username": username},
+            {"$inc": {"data_version": 1}},
+            projection={"data_version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        version = (user or {}).get("data_version", 0)
+        self.cache.set(username, version)
+        return version
+
+
+def compute_etag(*parts) -> str:
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison: ignore W/ prefixes on either side
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in if_none_match.split(","))
+
+def _cache_headers(etag: str) -> dict:
+    return {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Vary": "Authorization, Accept-Encoding",
+    }
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=_cache_headers(etag))
+
+# Serialize with orjson and gzip large bodies when the client accepts it
+def json_response(request: Request, payload, etag: str) -> Response:
+    body = orjson.dumps(payload)
+    headers = _cache_headers(etag)
+    if len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,222 @@
+# Bulk, idempotent ingest of session lifecycle events for clients that
+# buffer events offline. Sessions are identified by a client-generated
+# client_id and every event carries an idempotency key that is recorded on
+# its session, so a retried batch is recognised and applied only once.
+#
+# A batch costs one read (plus a bucket lookup for sessions not found) and
+# one unordered bulk_write per session collection: events are folded in
+# order into a single upsert per session.
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+import buckets
+
+logger = logging.getLogger(__name__)
+
+INGEST_MAX_EVENTS = int(os.getenv("INGEST_MAX_EVENTS", "500"))
+
+DEFAULT_STUDY_INTERVAL = "25 minutes"
+
+
+async def ensure_indexes(db):
+    client_id_index = IndexModel(
+        [("user_id", ASCENDING), ("client_id", ASCENDING)],
+        unique=True,
+        partialFilterExpression={"client_id": {"$exists": True}}
+    )
+    await db.study_sessions.create_indexes([client_id_index])
+    await db.break_sessions.create_indexes([client_id_index])
+
+
+# Store times as naive UTC like the rest of the sessions
+def _utc(moment: datetime) -> datetime:
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _collection(db, kind: str):
+    return db.study_sessions if kind == "study" else db.break_sessions
+
+
+def _start_fields(user_id: str, event) -> dict:
+    time_of_day = event.time_of_day
+    fields = {
+        "user_id": user_id,
+        "client_id": event.session_id,
+        "start_time": _utc(event.timestamp),
+        "end_time": None,
+        "completed": False,
+        "time_of_day": time_of_day.strip().lower() if time_of_day else None,
+    }
+    if event.kind == "study":
+        fields.update({
+            "study_interval": event.study_interval or DEFAULT_STUDY_INTERVAL,
+            "break_activity": "",
+            "duration": 25,
+            "notes": None,
+        })
+    else:
+        fields.update({
+            "activity": event.activity or "",
+            "duration": 5,
+            "energy_level_before": event.energy_level,
+            "energy_level_after": None,
+        })
+    return fields
+
+
+def _end_fields(event) -> dict:
+    fields = {"end_time": _utc(event.timestamp), "completed": True}
+    if event.kind == "study":
+        fields["notes"] = event.notes
+    else:
+        fields["energy_level_after"] = event.energy_level
+    return fields
+
+
+def _validate(event):
+    if event.kind == "break" and event.energy_level is None:
+        return "energy_level is required for break events"
+    return None
+
+
+# Apply an ordered batch of events for one user. Returns one result dict
+# per event (status "applied", "duplicate" or "rejected") and the sessions
+# completed by this batch, for rollups.
+async def apply_events(db, user_id: str, events: list):
+    results = [{"index": i, "session_id": event.session_id} for i, event in enumerate(events)]
+
+    # One read per collection for the sessions this batch touches
+    client_ids = {"study": set(), "break": set()}
+    for event in events:
+        client_ids[event.kind].add(event.session_id)
+
+    async def load(kind):
+        if not client_ids[kind]:
+            return {}
+        docs = await _collection(db, kind).find(
+            {"user_id": user_id, "client_id": {"$in": list(client_ids[kind])}}
+        ).to_list(length=None)
+        found = {doc["client_id"]: doc for doc in docs}
+        # Sessions already compacted into buckets must not be started again
+        missing = client_ids[kind] - found.keys()
+        if missing and buckets.reads_enabled:
+            found.update(await buckets.find_client_sessions(db, user_id, kind, missing))
+        return found
+
+    existing = dict(zip(("study", "break"), await asyncio.gather(load("study"), load("break"))))
+
+    # Fold the events into the state each session should end up in
+    sessions = {}
+    for result, event in zip(results, events):
+        error = _validate(event)
+        if error:
+            result.update(status="rejected", error=error)
+            continue
+
+        key = (event.kind, event.session_id)
+        doc = existing[event.kind].get(event.session_id)
+        state = sessions.get(key)
+        if state is None:
+            state = sessions[key] = {"doc": doc, "fields": None, "end": None, "end_result": None, "keys": []}
+        known_keys = set((doc or {}).get("event_keys", [])) | set(state["keys"])
+        if event.idempotency_key in known_keys:
+            result["status"] = "duplicate"
+            continue
+
+        started = doc is not None or state["fields"] is not None
+        ended = (doc or {}).get("completed") or state["end"] is not None
+        if event.action == "start":
+            if started:
+                result.update(status="duplicate", error="Session already started")
+                continue
+            state["fields"] = _start_fields(user_id, event)
+        else:
+            if not started:
+                result.update(status="rejected", error="Session not found")
+                continue
+            if ended:
+                result.update(status="duplicate", error="Session already ended")
+                continue
+            # Client clocks aren't trusted to keep negative durations out of the stats
+            start_time = (state["fields"] or doc)["start_time"]
+            if _utc(event.timestamp) < start_time:
+                result.update(status="rejected", error="Session can't end before it started")
+                continue
+            state["end"] = _end_fields(event)
+            state["end_result"] = result
+        state["keys"].append(event.idempotency_key)
+        result["status"] = "applied"
+
+    # One upsert per session: new sessions are inserted whole (so replays
+    # and concurrent copies of the batch change nothing), open ones are only
+    # ended if they are still open, tagged with this batch so we can tell
+    # which ones it ended
+    batch_id = ObjectId()
+    operations = {"study": [], "break": []}
+    inserted = {"study": {}, "break": {}}
+    ending = {"study": [], "break": []}
+    session_ids = {}
+    for (kind, client_id), state in sessions.items():
+        if state["doc"] is not None:
+            session_ids[(kind, client_id)] = state["doc"]["_id"]
+        if not state["keys"]:
+            continue
+        if state["fields"] is not None:
+            document = {**state["fields"], **(state["end"] or {})}
+            inserted[kind][len(operations[kind])] = document
+            operations[kind].append(UpdateOne(
+                {"user_id": user_id, "client_id": client_id},
+                {"$setOnInsert": {**document, "event_keys": state["keys"]}},
+                upsert=True
+            ))
+        else:
+            ending[kind].append(({**state["doc"], **state["end"]}, state["end_result"]))
+            operations[kind].append(UpdateOne(
+                {"_id": state["doc"]["_id"], "completed": False},
+                {
+                    "$set": {**state["end"], "ended_by_batch": batch_id},
+                    "$addToSet": {"event_keys": {"$each": state["keys"]}}
+                }
+            ))
+
+    async def write(kind):
+        if not operations[kind]:
+            return []
+        result = await _collection(db, kind).bulk_write(operations[kind], ordered=False)
+        # Roll up only what this write changed: sessions it inserted (a
+        # concurrent copy of the batch may have won the upsert) and open
+        # sessions it ended
+        completed = []
+        for index, session_id in result.upserted_ids.items():
+            document = inserted[kind][index]
+            session_ids[(kind, document["client_id"])] = session_id
+            if document["completed"]:
+                completed.append(document)
+        ended = ending[kind]
+        if ended and result.modified_count != len(ended):
+            # Some sessions were ended concurrently: keep the ones this batch ended
+            docs = await _collection(db, kind).find(
+                {"_id": {"$in": [session["_id"] for session, _ in ended]}, "ended_by_batch": batch_id},
+                {"_id": 1}
+            ).to_list(length=None)
+            ours = {doc["_id"] for doc in docs}
+            for session, event_result in ended:
+                if session["_id"] not in ours:
+                    event_result.update(status="duplicate", error="Session already ended")
+            ended = [(session, event_result) for session, event_result in ended if session["_id"] in ours]
+        completed.extend(session for session, _ in ended)
+        return completed
+
+    completed_study, completed_breaks = await asyncio.gather(write("study"), write("break"))
+
+    for result, event in zip(results, events):
+        session_id = session_ids.get((event.kind, event.session_id))
+        result["id"] = str(session_id) if session_id is not None else None
+    return results, completed_study, completed_breaks
@@ -1,19 +1,42 @@
 # Import necessary libraries
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Query, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pydantic import BaseModel, EmailStr, Field
+from typing import List, Literal, Optional
 import os
 from dotenv import load_dotenv
-from openai import OpenAI, OpenAIError
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAIError
+import anyio
+import asyncio
+import hashlib
+import httpx
+import json
 import logging
+import math
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 import random
+from cache import CoalescingCache, TTLCache
+import passwords
+import history
+import personalization
+import precompute
+import ratelimit
+import http_cache
+import ingest
+import buckets
+import metrics
+import recommender
+import stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,8 +45,35 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env file
 load_dotenv()
 
+# Clients are created per process inside the application lifespan (never
+# at import time, so forked workers don't share sockets), pre-warmed before
+# the first request is accepted and closed on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db, openai_client
+    client = create_mongo_client()
+    db = client.breakbetter  # Create/access database named 'breakbetter'
+    openai_client = create_openai_client()
+    await prewarm()
+    personalization_task = asyncio.create_task(personalization.refresh_periodically(
+        db, set_personalization_model, PERSONALIZATION_REFRESH_SECONDS
+    ))
+    # Roll old sessions into time buckets (optional storage mode)
+    compactor_task = asyncio.create_task(buckets.compact_periodically(db)) if buckets.SESSION_BUCKETS else None
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    personalization_task.cancel()
+    if compactor_task is not None:
+        compactor_task.cancel()
+    await precomputer.close()
+    password_executor.shutdown(wait=False, cancel_futures=True)
+    await openai_client.close()
+    client.close()
+
 # Initialize FastAPI application with title and description
-app = FastAPI(title="BreakBetter", description="AI-powered break recommendation system")
+app = FastAPI(title="BreakBetter", description="AI-powered break recommendation system", lifespan=lifespan)
+app.state.ready = False
 
 # Configure CORS (Cross-Origin Resource Sharing) to allow frontend to communicate with backend
 app.add_middleware(
@@ -34,22 +84,163 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Record per-route latency and in-flight requests for /metrics
+app.add_middleware(metrics.MetricsMiddleware, fastapi_app=app)
+
+# MongoDB connection pool settings (per worker process). MONGODB_MIN_POOL_SIZE
+# connections are opened in the background and kept warm.
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "10"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000"))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000"))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "300000"))
+
 # Connect to MongoDB using the connection string from environment variables
-client = AsyncIOMotorClient(os.getenv("MONGODB_URL"))
-db = client.breakbetter  # Create/access database named 'breakbetter'
+def create_mongo_client():
+    return AsyncIOMotorClient(
+        os.getenv("MONGODB_URL"),
+        maxPoolSize=MONGODB_MAX_POOL_SIZE,
+        minPoolSize=MONGODB_MIN_POOL_SIZE,
+        serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+        socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS,
+        maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+        event_listeners=[metrics.MongoCommandMetrics()]
+    )
+
+client = None
+db = None
+
+# LLM call limits: per-attempt timeout, overall deadline (including retries),
+# how many completions may be in flight at once and how many may wait for a slot
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "20"))
+OPENAI_DEADLINE_SECONDS = float(os.getenv("OPENAI_DEADLINE_SECONDS", "45"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "100"))
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", "500"))
+OPENAI_QUEUE_TIMEOUT_SECONDS = float(os.getenv("OPENAI_QUEUE_TIMEOUT_SECONDS", "10"))
+
+# Retries of failed OpenAI attempts: at most OPENAI_MAX_RETRIES per call, and
+# only while the retry budget (a share of recent first attempts) allows
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BUDGET_RATIO = float(os.getenv("OPENAI_RETRY_BUDGET_RATIO", "0.1"))
+OPENAI_RETRY_BUDGET_MAX = float(os.getenv("OPENAI_RETRY_BUDGET_MAX", "10"))
+
+# Model and completion budget for recommendations. JSON mode needs a model
+# that supports it (gpt-3.5-turbo-1106 or later); set OPENAI_JSON_MODE=false
+# for older models and the schema in the prompt alone shapes the reply.
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo-1106")
+OPENAI_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "250"))
+OPENAI_TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
+OPENAI_JSON_MODE = os.getenv("OPENAI_JSON_MODE", "true").lower() == "true"
+
+# HTTP connection pool for the LLM client. Keep-alive connections are reused
+# across completions so most calls skip the TCP/TLS handshake.
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", str(OPENAI_MAX_CONCURRENCY)))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "30"))
+OPENAI_PREWARM = os.getenv("OPENAI_PREWARM", "true").lower() == "true"
+
+# Initialize the async OpenAI client so LLM round trips never block the event loop
+# (the response hook counts every HTTP attempt, including retries). The SDK's
+# own retries are off; openai_request retries under the retry budget.
+def create_openai_client():
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,
+        timeout=OPENAI_TIMEOUT_SECONDS,
+        http_client=httpx.AsyncClient(
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS
+            ),
+            event_hooks={"response": [metrics.record_llm_http_response]}
+        )
+    )
 
-# Initialize OpenAI client with minimal configuration
-openai_client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    max_retries=3
+openai_client = None
+
+# Bounded pool of outstanding LLM calls shared by every request on this worker
+llm_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+llm_waiting = 0
+
+# Circuit breaker and latency budget for the LLM. When the breaker is open, or
+# a completion takes longer than the budget, the local engine answers instead
+# (a late completion still lands in the cache for the next request).
+LLM_LATENCY_BUDGET_SECONDS = float(os.getenv("LLM_LATENCY_BUDGET_SECONDS", "8"))
+llm_breaker = recommender.CircuitBreaker(
+    failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+)
+
+# Admission control in front of the recommendation endpoints: per-user and
+# global token buckets (per worker), plus the LLM retry budget. The latency
+# estimate is a moving average of completion time, used to predict how long
+# a new call would wait for a pool slot.
+rate_limiter = ratelimit.RateLimiter(ratelimit.LocalBucketStore())
+llm_retry_budget = ratelimit.RetryBudget(ratio=OPENAI_RETRY_BUDGET_RATIO, max_tokens=OPENAI_RETRY_BUDGET_MAX)
+llm_latency_estimate = float(os.getenv("LLM_LATENCY_ESTIMATE_SECONDS", "2"))
+
+# Batch recommendations: max profiles per request and how many unique
+# profiles from one batch may be resolved at the same time
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "200"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "20"))
+
+# Recommendation cache: TTL + LRU per worker, optionally backed by a SQLite
+# file shared between workers on the same host
+recommendation_cache = CoalescingCache(
+    maxsize=int(os.getenv("RECOMMENDATION_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("RECOMMENDATION_CACHE_TTL_SECONDS", "3600")),
+    shared_path=os.getenv("RECOMMENDATION_CACHE_PATH") or None
 )
 
+# Predicted next recommendation per user, computed in the background when a
+# study session ends or a break starts, for the time of day the client
+# recorded on that session (else the one in the user's profile).
+precomputer = precompute.Precomputer()
+
+# Per-user parameters learned from session history. Updated in place as
+# sessions end on this worker and rebuilt from MongoDB every
+# PERSONALIZATION_REFRESH_SECONDS (by one worker per host, which shares it
+# with the rest) to pick up the other workers' sessions.
+personalization_model = personalization.PersonalizationModel()
+PERSONALIZATION_REFRESH_SECONDS = float(os.getenv("PERSONALIZATION_REFRESH_SECONDS", "3600"))
+
+# Per-user data versions backing the ETags on /api/stats and /api/history.
+# Stats ETags also roll over every STATS_ETAG_WINDOW_SECONDS because the
+# window slides even when nothing new is recorded.
+user_versions = http_cache.UserVersions()
+STATS_ETAG_WINDOW_SECONDS = int(os.getenv("STATS_ETAG_WINDOW_SECONDS", "60"))
+
 # Security configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Authenticated principals are cached per worker so hot paths skip the users
+# lookup. PRINCIPAL_CACHE_TTL_SECONDS bounds how stale a cached user can be
+# (e.g. on other workers after a change); decoded tokens are cached too.
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+principal_cache = TTLCache(
+    maxsize=int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000")),
+    ttl=PRINCIPAL_CACHE_TTL_SECONDS
+)
+token_cache = TTLCache(
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300"))
+)
+
+# bcrypt runs in a process pool so hashing scales across cores and never
+# blocks the event loop; jobs beyond the queue limit are rejected with 503
+# (by default the cores are split between the web workers of this host)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+password_executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+password_jobs = 0
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Define the data model for user profile using Pydantic
@@ -73,6 +264,55 @@ class BreakRecommendation(BaseModel):
     description: str  # Detailed explanation of the recommendation
     benefits: List[str]  # What benefits they'll get from this break
     study_tips: List[str]  # Tips for effective studying
+    source: str = "llm"  # "llm" or "local" (rule-based engine)
+
+# The part of a recommendation the LLM writes, parsed from its JSON reply.
+# Study interval and duration are computed locally and never asked for.
+class LLMRecommendation(BaseModel):
+    break_activity: str
+    description: str
+    benefits: List[str] = ["Improved focus", "Better retention", "Reduced fatigue"]
+    study_tips: List[str] = ["Take regular breaks", "Stay hydrated", "Maintain good posture"]
+
+# Models for batch (cohort) recommendations
+class BatchRecommendationRequest(BaseModel):
+    profiles: List[UserProfile]
+
+class BatchRecommendationItem(BaseModel):
+    index: int  # Position of the profile in the request
+    recommendation: Optional[BreakRecommendation] = None
+    status_code: int = 200
+    error: Optional[str] = None
+
+class BatchRecommendationResponse(BaseModel):
+    results: List[BatchRecommendationItem]
+
+# Models for bulk session event ingest. session_id is generated by the
+# client; idempotency_key is unique per event so retried batches are safe.
+class SessionEvent(BaseModel):
+    kind: Literal["study", "break"]
+    action: Literal["start", "end"]
+    session_id: str = Field(min_length=1, max_length=128)
+    idempotency_key: str = Field(min_length=1, max_length=128)
+    timestamp: datetime  # When the event happened on the client
+    study_interval: Optional[str] = None  # Study start: planned interval
+    time_of_day: Optional[str] = None  # Start: the client's "morning" or "evening"
+    activity: Optional[str] = None  # Break start: activity taken
+    energy_level: Optional[int] = None  # Break start/end: energy before/after
+    notes: Optional[str] = None  # Study end
+
+class SessionEventBatch(BaseModel):
+    events: List[SessionEvent]
+
+class SessionEventResult(BaseModel):
+    index: int
+    session_id: str
+    status: Literal["applied", "duplicate", "rejected"]
+    id: Optional[str] = None  # Server id of the session, when it exists
+    error: Optional[str] = None
+
+class SessionEventBatchResponse(BaseModel):
+    results: List[SessionEventResult]
 
 # New models for authentication
 class User(BaseModel):
@@ -106,6 +346,7 @@ class StudySession(BaseModel):
     duration: int
     completed: bool = False
     notes: Optional[str] = None
+    time_of_day: Optional[str] = None  # Client's time of day at start
 
 class BreakSession(BaseModel):
     user_id: str
@@ -116,13 +357,29 @@ class BreakSession(BaseModel):
     completed: bool = False
     energy_level_before: int
     energy_level_after: Optional[int] = None
+    time_of_day: Optional[str] = None  # Client's time of day at start
 
 # Helper functions for authentication
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def run_password_job(func, *args):
+    global password_jobs
+    if password_jobs >= PASSWORD_HASH_MAX_QUEUE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication service is busy, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    password_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, func, *args)
+    finally:
+        password_jobs -= 1
+
+async def verify_and_update_password(plain_password, hashed_password):
+    return await run_password_job(passwords.verify_and_update_password, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await run_password_job(passwords.get_password_hash, password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -134,24 +391,161 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Reserve a slot in the bounded LLM pool, shedding load when the queue is full
+@asynccontextmanager
+async def llm_slot():
+    global llm_waiting
+    # Shed load straight away when too many calls are already queued for a
+    # slot, or when the queue is deep enough that the wait would time out
+    expected_wait = llm_waiting / OPENAI_MAX_CONCURRENCY * llm_latency_estimate
+    if llm_waiting >= OPENAI_MAX_QUEUE or expected_wait > OPENAI_QUEUE_TIMEOUT_SECONDS:
+        metrics.ADMISSION_REJECTIONS.labels("llm_queue").inc()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Recommendation service is busy, please retry shortly",
+            headers={"Retry-After": str(max(1, math.ceil(expected_wait)))},
+        )
+    llm_waiting += 1
+    metrics.LLM_POOL_WAITING.inc()
+    try:
+        await asyncio.wait_for(llm_semaphore.acquire(), timeout=OPENAI_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Recommendation service is busy, please retry shortly",
+            headers={"Retry-After": str(int(OPENAI_QUEUE_TIMEOUT_SECONDS))},
+        )
+    finally:
+        llm_waiting -= 1
+        metrics.LLM_POOL_WAITING.dec()
+    metrics.LLM_POOL_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        metrics.LLM_POOL_IN_FLIGHT.dec()
+        llm_semaphore.release()
+
+# Same set of errors the OpenAI SDK retries by default
+def is_retryable(error: OpenAIError) -> bool:
+    if isinstance(error, APIConnectionError):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code in (408, 409, 429) or error.status_code >= 500)
+
+# Run an OpenAI call, retrying retryable errors with jittered exponential
+# backoff while the retry budget allows
+async def openai_request(call):
+    llm_retry_budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except OpenAIError as e:
+            if attempt >= OPENAI_MAX_RETRIES or not is_retryable(e):
+                raise
+            if not llm_retry_budget.withdraw():
+                metrics.LLM_RETRIES.labels("denied").inc()
+                raise
+            metrics.LLM_RETRIES.labels("allowed").inc()
+            attempt += 1
+            await asyncio.sleep(min(8.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+def update_llm_latency_estimate(started: float):
+    global llm_latency_estimate
+    llm_latency_estimate = 0.9 * llm_latency_estimate + 0.1 * (time.perf_counter() - started)
+
+# Helper to run a chat completion inside the bounded LLM pool with a hard deadline
+async def create_chat_completion(**kwargs):
+    async with llm_slot():
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                openai_request(lambda: openai_client.chat.completions.create(**kwargs)),
+                timeout=OPENAI_DEADLINE_SECONDS
+            )
+        except asyncio.TimeoutError as e:
+            llm_breaker.record_failure()
+            metrics.record_llm_call(kwargs.get("model"), "complete", started, error=e)
+            logger.error(f"OpenAI request exceeded {OPENAI_DEADLINE_SECONDS}s deadline")
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Timed out waiting for recommendation"
+            )
+        except OpenAIError as e:
+            llm_breaker.record_failure()
+            metrics.record_llm_call(kwargs.get("model"), "complete", started, error=e)
+            raise
+        llm_breaker.record_success()
+        update_llm_latency_estimate(started)
+        metrics.record_llm_call(kwargs.get("model"), "complete", started, usage=response.usage)
+        return response
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    token_data = token_cache.get(token)
+    if token_data is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+            token_data = TokenData(username=username)
+        except JWTError:
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    user = await db.users.find_one({"username": token_data.username})
+        # Never keep a decoded token past its own expiry
+        ttl = token_cache.ttl
+        if "exp" in payload:
+            ttl = min(ttl, payload["exp"] - time.time())
+        token_cache.set(token, token_data, ttl=ttl)
+
+    user = principal_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
-    return UserInDB(**user)
+        user_doc = await db.users.find_one({"username": token_data.username})
+        if user_doc is None:
+            raise credentials_exception
+        user = UserInDB(**user_doc)
+        principal_cache.set(token_data.username, user)
+    if user.disabled:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive user")
+    return user
+
+# Drop a cached principal; call whenever a user document is changed or disabled
+def invalidate_principal(username: str):
+    principal_cache.pop(username)
+
+# Admission control for recommendation requests: 429 when the user is over
+# their rate, 503 when the worker as a whole is. `cost` (e.g. the number of
+# profiles in a batch) is charged to both the user's and the global bucket.
+def admit(username: str, cost: int = 1):
+    rejected = rate_limiter.admit(username, cost)
+    if rejected is None:
+        return
+    scope, wait = rejected
+    metrics.ADMISSION_REJECTIONS.labels(f"{scope}_rate").inc()
+    if scope == "user":
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many recommendation requests, please slow down",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Recommendation service is busy, please retry shortly",
+        headers={"Retry-After": str(max(1, math.ceil(wait)))},
+    )
+
+async def admit_recommendation(current_user: User = Depends(get_current_user)) -> User:
+    admit(current_user.username)
+    return current_user
+
+# Prometheus scrape endpoint
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
 
 # Root endpoint - just a welcome message
 @app.get("/")
@@ -162,12 +556,26 @@ async def root():
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     user = await db.users.find_one({"username": form_data.username})
-    if not user or not verify_password(form_data.password, user["hashed_password"]):
+    if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    valid, new_hash = await verify_and_update_password(form_data.password, user["hashed_password"])
+    if not valid:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    # Transparently rehash when the bcrypt cost has changed since this hash was made
+    if new_hash:
+        await db.users.update_one(
+            {"username": user["username"]},
+            {"$set": {"hashed_password": new_hash}}
+        )
+        invalidate_principal(user["username"])
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user["username"]}, expires_delta=access_token_expires
@@ -184,7 +592,7 @@ async def register_user(user: UserCreate):
         )
     
     # Create new user
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     user_dict = user.dict()
     user_dict["hashed_password"] = hashed_password
     del user_dict["password"]
@@ -202,6 +610,8 @@ async def create_profile(
         profile_dict = profile.dict()
         profile_dict["user_id"] = current_user.username
         await db.profiles.insert_one(profile_dict)
+        await user_versions.bump(db, current_user.username)
+        precomputer.invalidate(current_user.username)
         return profile
     except Exception as e:
         logger.error(f"Error creating profile: {str(e)}")
@@ -210,96 +620,523 @@ async def create_profile(
 @app.post("/api/recommend", response_model=BreakRecommendation)
 async def get_recommendation(
     profile: UserProfile,
-    current_user: User = Depends(get_current_user)
+    background_tasks: BackgroundTasks,
+    tier: Literal["auto", "fast"] = "auto",
+    current_user: User = Depends(admit_recommendation)
 ):
     try:
         logger.info(f"Received recommendation request for user: {profile.name}")
-        
-        # Validate OpenAI API key
-        if not openai_client.api_key:
-            logger.error("OpenAI API key not found")
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+        recommendation = precomputer.get(current_user.username, profile_fingerprint(profile))
+        if recommendation is not None:
+            metrics.RECOMMENDATION_CACHE_REQUESTS.labels("precomputed").inc()
+        else:
+            recommendation = await resolve_recommendation(profile, tier, current_user.username)
+        recommendation = personalize_recommendation(recommendation, current_user.username, profile)
+        # Write the history entry after the response has been sent
+        background_tasks.add_task(record_recommendation, current_user.username, profile, recommendation)
+        return BreakRecommendation(**recommendation)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting recommendation: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error getting recommendation: {str(e)}")
 
-        # Calculate the optimal study interval based on user's profile
-        study_interval = determine_study_interval(profile)
-        
-        # Process personal preferences
-        preferences_list = [pref.strip() for pref in profile.personal_preferences.split(',')]
-        
-        # Create a detailed prompt for OpenAI
-        prompt = f"""
-        Based on the following user profile, suggest a personalized break activity and study interval:
-        
-        Name: {profile.name}
-        Study Type: {profile.study_interval}
-        Time of Day: {profile.time_of_day}
-        Deadline Pressure: {profile.deadline_pressure}
-        Personal Preferences: {', '.join(preferences_list)}
-        Screen Usage: {'Yes' if profile.screen_usage else 'No'}
-        Activity Level: {profile.activity_level}
-        Energy Level: {profile.energy_level}/10
-        Preferred Break Duration: {profile.preferred_break_duration} minutes
-
-        Please provide:
-        1. An appropriate study interval duration
-        2. A specific break activity that:
-           - Aligns with their preferences 
-           - Considers their screen usage
-           - Matches their activity level
-           - Is appropriate for their energy level
-        3. Study tips for maintaining focus
-        """
-
-        logger.info("Sending request to OpenAI")
-        # Get recommendation from OpenAI using the new API format
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful study and break recommendation assistant."},
-                {"role": "user", "content": prompt}
-            ]
+# Batch endpoint for cohorts: equivalent profiles are resolved once and the
+# unique ones fan out concurrently under a bounded limit
+@app.post("/api/recommend/batch", response_model=BatchRecommendationResponse)
+async def get_batch_recommendations(
+    batch: BatchRecommendationRequest,
+    tier: Literal["auto", "fast"] = "auto",
+    current_user: User = Depends(get_current_user)
+):
+    if len(batch.profiles) > BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch may contain at most {BATCH_MAX_SIZE} profiles"
         )
 
-        recommendation = response.choices[0].message.content
-        logger.info("Received response from OpenAI")
-
-        # Return the recommendation in the specified format
-        return BreakRecommendation(
-            study_interval=study_interval,
-            break_activity=recommendation.split("\n")[0],
-            duration=profile.preferred_break_duration,
-            description=recommendation,
-            benefits=["Improved focus", "Better retention", "Reduced fatigue"],
-            study_tips=["Take regular breaks", "Stay hydrated", "Maintain good posture"]
+    logger.info(f"Received batch of {len(batch.profiles)} recommendation requests from user: {current_user.username}")
+
+    # Group request positions by fingerprint, keeping one representative profile
+    unique_profiles = {}
+    for profile in batch.profiles:
+        unique_profiles.setdefault(profile_fingerprint(profile), profile)
+    admit(current_user.username, cost=len(unique_profiles))
+
+    limit = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def resolve(key, profile):
+        async with limit:
+            try:
+                return {"recommendation": await resolve_recommendation(profile, tier, current_user.username)}
+            except HTTPException as e:
+                return {"status_code": e.status_code, "error": str(e.detail)}
+            except Exception as e:
+                logger.error(f"Error getting batch recommendation: {str(e)}")
+                return {"status_code": 500, "error": f"Error getting recommendation: {str(e)}"}
+
+    keys = list(unique_profiles)
+    resolved = dict(zip(keys, await asyncio.gather(*(resolve(key, unique_profiles[key]) for key in keys))))
+
+    # Results come back in request order, one per submitted profile
+    return BatchRecommendationResponse(results=[
+        BatchRecommendationItem(index=index, **resolved[profile_fingerprint(profile)])
+        for index, profile in enumerate(batch.profiles)
+    ])
+
+# Store a served recommendation in the user's history
+async def record_recommendation(username: str, profile: UserProfile, recommendation: dict):
+    try:
+        await db.recommendations.insert_one({
+            **recommendation,
+            "user_id": username,
+            "timestamp": datetime.utcnow(),
+            "profile": normalize_profile(profile),
+        })
+        await user_versions.bump(db, username)
+    except Exception as e:
+        logger.error(f"Error recording recommendation: {str(e)}")
+
+# Per-user, per-day token accounting. A completion is charged to the user
+# whose request triggered it; cache hits and coalesced requests are free.
+async def record_token_usage(username: Optional[str], prompt_tokens: int, completion_tokens: int):
+    if not username:
+        return
+    try:
+        await db.token_usage.update_one(
+            {"user_id": username, "day": stats.day_start(datetime.utcnow()), "model": OPENAI_MODEL},
+            {"$inc": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "requests": 1,
+            }},
+            upsert=True
         )
     except Exception as e:
-        logger.error(f"Error getting recommendation: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error getting recommendation: {str(e)}")
+        logger.error(f"Error recording token usage: {str(e)}")
+
+# Predict the profile a user will send next (their latest stored profile,
+# with the time of day from the clock and the energy level they just
+# reported, if any) and make sure an LLM recommendation for it is ready.
+# Runs as a cancellable background job; see precompute.Precomputer.
+async def predict_recommendation(username: str, energy_level: Optional[int] = None, time_of_day: Optional[str] = None):
+    # Leave trial calls to live traffic while the breaker isn't closed, and
+    # don't precompute what the local engine answers instantly anyway
+    if not openai_client.api_key or llm_breaker.state != "closed":
+        return None
+    doc = await db.profiles.find_one({"user_id": username}, sort=[("_id", -1)])
+    if doc is None:
+        return None
+    if time_of_day:
+        doc["time_of_day"] = time_of_day
+    if energy_level is not None:
+        doc["energy_level"] = energy_level
+    profile = UserProfile(**doc)
+
+    key = profile_fingerprint(profile)
+    recommendation = recommendation_cache.local.get(key)
+    if recommendation is None:
+        # Not coalesced through the cache on purpose: a superseded prediction
+        # is cancelled together with its completion
+        recommendation = await generate_recommendation(profile, username)
+        recommendation_cache.local.set(key, recommendation)
+    return key, recommendation
+
+# The time of day a client sent for a new session. Sessions are slotted on
+# it, so what is learned lands in the slot recommendations look up for the
+# same time of day; sessions without one are slotted by their start hour.
+def client_time_of_day(time_of_day: Optional[str]) -> Optional[str]:
+    return time_of_day.strip().lower() if time_of_day else None
+
+def set_personalization_model(model: personalization.PersonalizationModel):
+    global personalization_model
+    personalization_model = model
+
+# The study interval the user completes best (or the profile's, adjusted by
+# how often they finish) in minutes; None to keep the profile's
+def personalized_minutes(username: str, profile: UserProfile) -> Optional[int]:
+    time_of_day = profile.time_of_day.strip().lower()
+    baseline = personalization.planned_minutes(determine_study_interval(profile))
+    return personalization_model.study_interval(username, time_of_day, baseline)
+
+# Tailor a recommendation to the user from the personalization table: the
+# personalized study interval and, for local answers, the activities that
+# have lifted their (and their cohort's) energy
+def personalize_recommendation(recommendation: dict, username: str, profile: UserProfile) -> dict:
+    time_of_day = profile.time_of_day.strip().lower()
+    minutes = personalized_minutes(username, profile)
+    study_interval = f"{minutes} minutes" if minutes else recommendation["study_interval"]
+    if recommendation.get("source") == "local":
+        bonus = personalization_model.activity_scores(username, time_of_day)
+        if bonus is not None:
+            return recommender.recommend(normalize_profile(profile), study_interval, bonus)
+    if minutes:
+        return {**recommendation, "study_interval": study_interval}
+    return recommendation
+
+# Answer from the rule-based engine without touching the LLM
+def local_recommendation(profile: UserProfile) -> dict:
+    return recommender.recommend(normalize_profile(profile), determine_study_interval(profile))
+
+# Decide who answers a recommendation: the cache if it has one, the local
+# engine for the fast tier or while the LLM is unavailable, otherwise the LLM
+# within the latency budget, falling back to the local engine on failure
+async def resolve_recommendation(profile: UserProfile, tier: str = "auto", username: Optional[str] = None) -> dict:
+    key = profile_fingerprint(profile)
+    cached = recommendation_cache.local.get(key)
+    if cached is not None:
+        metrics.RECOMMENDATION_CACHE_REQUESTS.labels("cache_hit").inc()
+        return cached
+
+    if tier == "fast":
+        metrics.RECOMMENDATION_CACHE_REQUESTS.labels("local_fast").inc()
+        return local_recommendation(profile)
+    if not openai_client.api_key:
+        logger.warning("OpenAI API key not configured, serving local recommendation")
+        metrics.RECOMMENDATION_CACHE_REQUESTS.labels("local_fallback").inc()
+        return local_recommendation(profile)
+    if not llm_breaker.allow():
+        logger.info("LLM circuit breaker open, serving local recommendation")
+        metrics.RECOMMENDATION_CACHE_REQUESTS.labels("local_fallback").inc()
+        return local_recommendation(profile)
+
+    metrics.RECOMMENDATION_CACHE_REQUESTS.labels("llm").inc()
+    try:
+        # Serve equivalent profiles from the cache; concurrent misses share one
+        # completion. Shielded so a completion that overruns the budget keeps
+        # going and fills the cache.
+        return await asyncio.wait_for(
+            asyncio.shield(recommendation_cache.get_or_compute(
+                key,
+                lambda: generate_recommendation(profile, username)
+            )),
+            timeout=LLM_LATENCY_BUDGET_SECONDS
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"LLM exceeded {LLM_LATENCY_BUDGET_SECONDS}s budget, serving local recommendation")
+    except (HTTPException, OpenAIError) as e:
+        logger.warning(f"LLM unavailable ({str(e)}), serving local recommendation")
+    except ValueError as e:
+        logger.warning(f"Unusable LLM reply ({str(e)}), serving local recommendation")
+    metrics.RECOMMENDATION_CACHE_REQUESTS.labels("local_fallback").inc()
+    return local_recommendation(profile)
+
+# Helper to bucket energy levels the same way determine_study_interval does
+def energy_band(energy_level: int) -> str:
+    if energy_level < 4:
+        return "low"
+    if energy_level > 7:
+        return "high"
+    return "medium"
+
+# Helper to reduce a profile to the features that shape a recommendation.
+# The user's name is left out so equivalent profiles share a cache entry.
+def normalize_profile(profile: UserProfile) -> dict:
+    preferences = sorted({
+        pref.strip().lower()
+        for pref in profile.personal_preferences.split(',')
+        if pref.strip()
+    })
+    return {
+        "study_interval": profile.study_interval.strip().lower(),
+        "time_of_day": profile.time_of_day.strip().lower(),
+        "deadline_pressure": profile.deadline_pressure.strip().lower(),
+        "personal_preferences": preferences,
+        "screen_usage": profile.screen_usage,
+        "activity_level": profile.activity_level.strip().lower(),
+        "energy_band": energy_band(profile.energy_level),
+        "preferred_break_duration": profile.preferred_break_duration,
+    }
+
+def profile_fingerprint(profile: UserProfile) -> str:
+    canonical = json.dumps(normalize_profile(profile), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+# Compact prompt: the schema of the JSON reply goes in the system message and
+# the profile is sent as terse key=value pairs. Built from the normalized
+# features only, so the answer is valid for every profile sharing this fingerprint.
+RECOMMENDATION_SYSTEM_PROMPT = (
+    "You recommend study breaks. Reply with one JSON object only: "
+    '{"break_activity": string, <=8 words, a specific activity; '
+    '"description": string, 1-2 sentences on how to do it; '
+    '"benefits": 3 short strings; "study_tips": 3 short strings for staying focused}. '
+    "Match the user's preferences, screen use, activity and energy level, and fit the break length."
+)
+
+def build_recommendation_messages(features: dict) -> list:
+    prompt = "; ".join([
+        f"task={features['study_interval']}",
+        f"time={features['time_of_day']}",
+        f"deadline={features['deadline_pressure']}",
+        f"prefs={','.join(features['personal_preferences']) or 'none'}",
+        f"screen={'yes' if features['screen_usage'] else 'no'}",
+        f"activity={features['activity_level']}",
+        f"energy={features['energy_band']}",
+        f"break={features['preferred_break_duration']}min",
+    ])
+    return [
+        {"role": "system", "content": RECOMMENDATION_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+# Model, token ceiling and response format shared by every recommendation call
+def recommendation_completion_options() -> dict:
+    options = {
+        "model": OPENAI_MODEL,
+        "max_tokens": OPENAI_MAX_TOKENS,
+        "temperature": OPENAI_TEMPERATURE,
+    }
+    if OPENAI_JSON_MODE:
+        options["response_format"] = {"type": "json_object"}
+    return options
+
+# Parse the JSON reply into a BreakRecommendation dict. Raises ValueError when
+# the reply isn't valid (e.g. cut off by max_tokens); callers fall back to
+# the local engine.
+def build_break_recommendation(profile: UserProfile, study_interval: str, recommendation: str) -> dict:
+    # Tolerate code fences or stray text around the object when JSON mode is off
+    start, end = recommendation.find("{"), recommendation.rfind("}")
+    if start == -1 or end < start:
+        metrics.LLM_ERRORS.labels(OPENAI_MODEL, "InvalidOutput").inc()
+        raise ValueError("reply is not a JSON object")
+    try:
+        parsed = LLMRecommendation.model_validate_json(recommendation[start:end + 1])
+    except ValueError:
+        metrics.LLM_ERRORS.labels(OPENAI_MODEL, "InvalidOutput").inc()
+        raise
+    return BreakRecommendation(
+        study_interval=study_interval,
+        duration=profile.preferred_break_duration,
+        **parsed.dict()
+    ).dict()
+
+# Ask OpenAI for a recommendation and return it as a BreakRecommendation dict
+async def generate_recommendation(profile: UserProfile, username: Optional[str] = None) -> dict:
+    # Calculate the optimal study interval based on user's profile
+    study_interval = determine_study_interval(profile)
+
+    logger.info("Sending request to OpenAI")
+    # Get recommendation from OpenAI without blocking other requests
+    response = await create_chat_completion(
+        messages=build_recommendation_messages(normalize_profile(profile)),
+        **recommendation_completion_options()
+    )
+
+    recommendation = response.choices[0].message.content
+    logger.info("Received response from OpenAI")
+    if response.usage is not None:
+        await record_token_usage(username, response.usage.prompt_tokens, response.usage.completion_tokens)
+
+    # Return the recommendation in the specified format
+    return build_break_recommendation(profile, study_interval, recommendation)
+
+# Rough prompt size for calls that don't report usage: about four
+# characters per token plus a few tokens of chat formatting per message
+def estimate_prompt_tokens(messages: list) -> int:
+    return sum(math.ceil(len(message["content"]) / 4) + 4 for message in messages) + 3
+
+# Format one Server-Sent Event
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Pulls the text of chosen top-level string fields out of a JSON reply as it
+# streams in. feed() takes the next completion chunk and returns
+# (field, text) pairs with the unescaped text added to those fields.
+class ReplyFieldStream:
+    ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+
+    def __init__(self, fields):
+        self.fields = set(fields)
+        self.depth = 0
+        self.after_colon = False
+        self.in_string = False
+        self.escape = None  # Characters after a backslash, while in an escape
+        self.key = None  # Last key read at the top level
+        self.reading_key = False
+        self.field = None  # Field whose value is being read, if one we want
+
+    def feed(self, chunk: str) -> list:
+        out = []
+        for ch in chunk:
+            if not self.in_string:
+                if ch == '"':
+                    self.in_string = True
+                    self.reading_key = self.depth == 1 and not self.after_colon
+                    if self.reading_key:
+                        self.key = ""
+                    self.field = self.key if self.depth == 1 and self.after_colon and self.key in self.fields else None
+                elif ch in "{[":
+                    self.depth += 1
+                    self.after_colon = False
+                elif ch in "}]":
+                    self.depth -= 1
+                elif self.depth == 1 and ch == ":":
+                    self.after_colon = True
+                elif self.depth == 1 and ch == ",":
+                    self.after_colon = False
+                continue
+
+            if self.escape is not None:
+                self.escape += ch
+                if self.escape.startswith("u"):
+                    if len(self.escape) < 5:
+                        continue
+                    try:
+                        ch = chr(int(self.escape[1:], 16))
+                    except ValueError:
+                        ch = ""
+                else:
+                    ch = self.ESCAPES.get(ch, ch)
+                self.escape = None
+            elif ch == "\\":
+                self.escape = ""
+                continue
+            elif ch == '"':
+                self.in_string = False
+                self.field = None
+                continue
+
+            if self.reading_key:
+                self.key += ch
+            elif self.field is not None:
+                if out and out[-1][0] == self.field:
+                    out[-1] = (self.field, out[-1][1] + ch)
+                else:
+                    out.append((self.field, ch))
+        return out
+
+# Stream a recommendation as Server-Sent Events: the computed study interval
+# first, then the break_activity and description text as it arrives (token
+# events carrying the field and the text added to it), then the final
+# recommendation. With a username, the interval and the final recommendation
+# are personalized as on /api/recommend.
+async def stream_recommendation(profile: UserProfile, tier: str = "auto", username: Optional[str] = None):
+    study_interval = determine_study_interval(profile)
+    minutes = personalized_minutes(username, profile) if username else None
+    yield sse_event("study_interval", {"study_interval": f"{minutes} minutes" if minutes else study_interval})
+
+    def final_event(recommendation: dict) -> str:
+        if username:
+            recommendation = personalize_recommendation(recommendation, username, profile)
+        return sse_event("recommendation", recommendation)
+
+    key = profile_fingerprint(profile)
+    cached = recommendation_cache.local.get(key)
+    if cached is not None:
+        metrics.RECOMMENDATION_CACHE_REQUESTS.labels("cache_hit").inc()
+        yield final_event(cached)
+        return
+
+    if tier == "fast" or not openai_client.api_key or not llm_breaker.allow():
+        metrics.RECOMMENDATION_CACHE_REQUESTS.labels("local_fast" if tier == "fast" else "local_fallback").inc()
+        yield final_event(local_recommendation(profile))
+        return
+
+    metrics.RECOMMENDATION_CACHE_REQUESTS.labels("llm").inc()
+    chunks = []
+    reply_fields = ReplyFieldStream(("break_activity", "description"))
+    messages = build_recommendation_messages(normalize_profile(profile))
+    try:
+        async with llm_slot():
+            logger.info("Sending streaming request to OpenAI")
+            started = time.perf_counter()
+            stream = await asyncio.wait_for(
+                openai_request(lambda: openai_client.chat.completions.create(
+                    messages=messages,
+                    stream=True,
+                    **recommendation_completion_options()
+                )),
+                timeout=OPENAI_TIMEOUT_SECONDS
+            )
+            deadline = asyncio.get_running_loop().time() + OPENAI_DEADLINE_SECONDS
+            try:
+                async for chunk in stream:
+                    if asyncio.get_running_loop().time() > deadline:
+                        raise asyncio.TimeoutError
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        chunks.append(delta)
+                        for field, text in reply_fields.feed(delta):
+                            yield sse_event("token", {"field": field, "text": text})
+            finally:
+                # Runs on completion, error, or when Starlette cancels us because
+                # the client disconnected: close the upstream connection so
+                # OpenAI stops generating tokens nobody will read
+                with anyio.CancelScope(shield=True):
+                    await stream.response.aclose()
+    except HTTPException as e:
+        # The LLM pool is saturated; answer locally rather than fail
+        logger.warning(f"LLM unavailable ({e.detail}), streaming local recommendation")
+        yield final_event(local_recommendation(profile))
+        return
+    except (asyncio.TimeoutError, OpenAIError) as e:
+        llm_breaker.record_failure()
+        metrics.record_llm_call(OPENAI_MODEL, "stream", started, error=e)
+        logger.error(f"Error streaming recommendation: {str(e) or 'deadline exceeded'}")
+        # The final event supersedes any tokens already sent
+        yield final_event(local_recommendation(profile))
+        return
+
+    llm_breaker.record_success()
+    update_llm_latency_estimate(started)
+    metrics.record_llm_call(OPENAI_MODEL, "stream", started, completion_chunks=len(chunks))
+    logger.info("Finished streaming response from OpenAI")
+    # Streamed completions don't report usage: the prompt is estimated from
+    # the messages sent and the completion is charged one token per chunk
+    await record_token_usage(username, estimate_prompt_tokens(messages), len(chunks))
+    try:
+        recommendation = build_break_recommendation(profile, study_interval, "".join(chunks))
+    except ValueError as e:
+        logger.warning(f"Unusable LLM reply ({str(e)}), streaming local recommendation")
+        yield final_event(local_recommendation(profile))
+        return
+    recommendation_cache.local.set(key, recommendation)
+    yield final_event(recommendation)
+
+# Streaming variant of /api/recommend using Server-Sent Events. The final
+# "recommendation" event is authoritative; if the LLM fails mid-stream it
+# carries a local recommendation instead of the partial text.
+@app.post("/api/recommend/stream")
+async def stream_recommendation_endpoint(
+    profile: UserProfile,
+    tier: Literal["auto", "fast"] = "auto",
+    current_user: User = Depends(admit_recommendation)
+):
+    logger.info(f"Received streaming recommendation request for user: {profile.name}")
+    return StreamingResponse(
+        stream_recommendation(profile, tier, current_user.username),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Helper function to determine the optimal study interval
 def determine_study_interval(profile: UserProfile) -> str:
     try:
+        # Work from the normalized features, so every profile sharing a
+        # fingerprint (and a cached recommendation) gets the same interval
+        features = normalize_profile(profile)
+
         # Start with the standard Pomodoro interval
         base_interval = 25  # Default 25-minute interval
         
         # Adjust based on mental energy required
-        if profile.study_interval == "high_mental":
+        if features["study_interval"] == "high_mental":
             base_interval -= 5  # Shorter intervals for high mental energy tasks
         else:
             base_interval += 5  # Longer intervals for low mental energy tasks
         
         # Adjust based on time of day
-        if profile.time_of_day == "evening":
+        if features["time_of_day"] == "evening":
             base_interval -= 5  # Shorter intervals in the evening
         
         # Adjust based on deadline pressure
-        if profile.deadline_pressure == "high":
+        if features["deadline_pressure"] == "high":
             base_interval += 5  # Longer intervals when deadline is near
         
         # Adjust based on energy level
-        if profile.energy_level < 4:
+        if features["energy_band"] == "low":
             base_interval -= 3  # Shorter intervals when energy is low
-        elif profile.energy_level > 7:
+        elif features["energy_band"] == "high":
             base_interval += 3  # Longer intervals when energy is high
         
         # Ensure the interval stays within reasonable bounds (15-50 minutes)
@@ -310,40 +1147,82 @@ def determine_study_interval(profile: UserProfile) -> str:
         logger.error(f"Error determining study interval: {str(e)}")
         return "25 minutes"  # Default fallback
 
-# New endpoint to get user's recommendation history
+# New endpoint to get user's recommendation history, newest first. Pass the
+# returned next_cursor to get the following page; `fields` limits the
+# returned fields (comma-separated). Supports If-None-Match.
 @app.get("/api/history")
 async def get_recommendation_history(
+    request: Request,
     current_user: User = Depends(get_current_user),
-    limit: int = 10
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
 ):
     try:
-        history = await db.recommendations.find(
-            {"user_id": current_user.username}
-        ).sort("timestamp", -1).limit(limit).to_list(length=limit)
-        return history
+        version = await user_versions.get(db, current_user.username)
+        etag = http_cache.compute_etag("history", current_user.username, version, limit, cursor, fields)
+        if http_cache.etag_matches(request.headers.get("if-none-match"), etag):
+            return http_cache.not_modified(etag)
+
+        items, next_cursor = await history.get_history_page(
+            db,
+            current_user.username,
+            limit,
+            cursor=cursor,
+            fields=history.parse_fields(fields)
+        )
+        return http_cache.json_response(request, {"items": items, "next_cursor": next_cursor}, etag)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error getting history: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error getting history: {str(e)}")
 
+# Stream all of a user's study or break sessions as NDJSON or CSV
+@app.get("/api/export/sessions")
+async def export_sessions(
+    kind: Literal["study", "break"] = "study",
+    format: Literal["ndjson", "csv"] = "ndjson",
+    since: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"{kind}_sessions.{'csv' if format == 'csv' else 'ndjson'}"
+    return StreamingResponse(
+        history.export_sessions(db, current_user.username, kind, format, since),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @app.post("/api/sessions/start")
 async def start_study_session(
+    study_interval: Optional[str] = None,
+    time_of_day: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
     try:
         session = StudySession(
             user_id=current_user.username,
             start_time=datetime.utcnow(),
-            study_interval="25 minutes",  # Default, will be updated with recommendation
+            study_interval=study_interval or "25 minutes",  # The recommended interval, if sent
             break_activity="",  # Will be updated with recommendation
             duration=25,  # Default, will be updated with recommendation
-            completed=False
+            completed=False,
+            time_of_day=client_time_of_day(time_of_day)
         )
-        await db.study_sessions.insert_one(session.dict())
-        return {"message": "Study session started", "session_id": str(session.id)}
+        result = await db.study_sessions.insert_one(session.dict())
+        await user_versions.bump(db, current_user.username)
+        return {"message": "Study session started", "session_id": str(result.inserted_id)}
     except Exception as e:
         logger.error(f"Error starting study session: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error starting study session: {str(e)}")
 
+# Helper to turn a path id into an ObjectId, treating malformed ids as not found
+def parse_object_id(value: str, not_found_detail: str) -> ObjectId:
+    if not ObjectId.is_valid(value):
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    return ObjectId(value)
+
 @app.post("/api/sessions/{session_id}/end")
 async def end_study_session(
     session_id: str,
@@ -351,20 +1230,33 @@ async def end_study_session(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        session = await db.study_sessions.find_one({"_id": session_id, "user_id": current_user.username})
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-        
+        session_oid = parse_object_id(session_id, "Session not found")
         update_data = {
             "end_time": datetime.utcnow(),
             "completed": True,
             "notes": notes
         }
-        await db.study_sessions.update_one(
-            {"_id": session_id},
-            {"$set": update_data}
+        # Only an open session transitions, so the rollup is counted exactly once
+        session = await db.study_sessions.find_one_and_update(
+            {"_id": session_oid, "user_id": current_user.username, "completed": False},
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
         )
+        if not session:
+            if await db.study_sessions.count_documents({"_id": session_oid, "user_id": current_user.username}, limit=1):
+                return {"message": "Study session already ended"}
+            raise HTTPException(status_code=404, detail="Session not found")
+
+        await stats.record_study_rollup(db, session)
+        await user_versions.bump(db, current_user.username)
+        personalization_model.observe_study_session(session)
+        # A break (and a recommendation request) usually follows
+        precomputer.schedule(current_user.username, lambda: predict_recommendation(
+            current_user.username, time_of_day=session.get("time_of_day")
+        ))
         return {"message": "Study session ended"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error ending study session: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error ending study session: {str(e)}")
@@ -372,19 +1264,26 @@ async def end_study_session(
 @app.post("/api/breaks/start")
 async def start_break_session(
     energy_level: int,
+    activity: Optional[str] = None,
+    time_of_day: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
     try:
         break_session = BreakSession(
             user_id=current_user.username,
             start_time=datetime.utcnow(),
-            activity="",  # Will be updated with recommendation
+            activity=activity or "",  # The recommended activity the user is taking, if sent
             duration=5,  # Default, will be updated with recommendation
             completed=False,
-            energy_level_before=energy_level
+            energy_level_before=energy_level,
+            time_of_day=client_time_of_day(time_of_day)
         )
-        await db.break_sessions.insert_one(break_session.dict())
-        return {"message": "Break session started", "break_id": str(break_session.id)}
+        result = await db.break_sessions.insert_one(break_session.dict())
+        await user_versions.bump(db, current_user.username)
+        precomputer.schedule(current_user.username, lambda: predict_recommendation(
+            current_user.username, energy_level, break_session.time_of_day
+        ))
+        return {"message": "Break session started", "break_id": str(result.inserted_id)}
     except Exception as e:
         logger.error(f"Error starting break session: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error starting break session: {str(e)}")
@@ -396,85 +1295,148 @@ async def end_break_session(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        break_session = await db.break_sessions.find_one({"_id": break_id, "user_id": current_user.username})
-        if not break_session:
-            raise HTTPException(status_code=404, detail="Break session not found")
-        
+        break_oid = parse_object_id(break_id, "Break session not found")
         update_data = {
             "end_time": datetime.utcnow(),
             "completed": True,
             "energy_level_after": energy_level
         }
-        await db.break_sessions.update_one(
-            {"_id": break_id},
-            {"$set": update_data}
+        # Only an open break transitions, so the rollup is counted exactly once
+        break_session = await db.break_sessions.find_one_and_update(
+            {"_id": break_oid, "user_id": current_user.username, "completed": False},
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
         )
+        if not break_session:
+            if await db.break_sessions.count_documents({"_id": break_oid, "user_id": current_user.username}, limit=1):
+                return {"message": "Break session already ended"}
+            raise HTTPException(status_code=404, detail="Break session not found")
+
+        await stats.record_break_rollup(db, break_session)
+        await user_versions.bump(db, current_user.username)
+        personalization_model.observe_break(break_session)
         return {"message": "Break session ended"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error ending break session: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error ending break session: {str(e)}")
 
+# Bulk ingest for clients that buffer session events (e.g. offline): an
+# ordered batch of start/end events applied with one bulk write per session
+# collection, with a result per event. Replaying a batch is safe.
+@app.post("/api/sessions/events", response_model=SessionEventBatchResponse)
+async def ingest_session_events(
+    batch: SessionEventBatch,
+    current_user: User = Depends(get_current_user)
+):
+    if len(batch.events) > ingest.INGEST_MAX_EVENTS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch may contain at most {ingest.INGEST_MAX_EVENTS} events"
+        )
+    try:
+        results, completed_study, completed_breaks = await ingest.apply_events(
+            db, current_user.username, batch.events
+        )
+        if any(result["status"] == "applied" for result in results):
+            await stats.record_rollups(db, completed_study, completed_breaks)
+            await user_versions.bump(db, current_user.username)
+            for session in completed_study:
+                personalization_model.observe_study_session(session)
+            for session in completed_breaks:
+                personalization_model.observe_break(session)
+        return SessionEventBatchResponse(results=results)
+    except Exception as e:
+        logger.error(f"Error ingesting session events: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error ingesting session events: {str(e)}")
+
 @app.get("/api/stats")
 async def get_user_stats(
+    request: Request,
     current_user: User = Depends(get_current_user),
     days: int = 7
 ):
     try:
-        start_date = datetime.utcnow() - timedelta(days=days)
-        
-        # Get study sessions
-        study_sessions = await db.study_sessions.find({
-            "user_id": current_user.username,
-            "start_time": {"$gte": start_date},
-            "completed": True
-        }).to_list(length=None)
-        
-        # Get break sessions
-        break_sessions = await db.break_sessions.find({
-            "user_id": current_user.username,
-            "start_time": {"$gte": start_date},
-            "completed": True
-        }).to_list(length=None)
-        
-        # Calculate statistics
-        total_study_time = sum(
-            (session["end_time"] - session["start_time"]).total_seconds() / 60
-            for session in study_sessions
-        )
-        
-        total_break_time = sum(
-            (session["end_time"] - session["start_time"]).total_seconds() / 60
-            for session in break_sessions
-        )
-        
-        # Calculate energy level changes
-        energy_changes = [
-            session["energy_level_after"] - session["energy_level_before"]
-            for session in break_sessions
-            if "energy_level_after" in session
-        ]
-        avg_energy_change = sum(energy_changes) / len(energy_changes) if energy_changes else 0
-        
-        return {
-            "total_study_time_minutes": total_study_time,
-            "total_break_time_minutes": total_break_time,
-            "study_sessions_count": len(study_sessions),
-            "break_sessions_count": len(break_sessions),
-            "average_energy_change": avg_energy_change,
-            "most_common_break_activities": get_most_common_activities(break_sessions)
-        }
+        # Unchanged data is answered with 304 before any aggregation runs
+        version = await user_versions.get(db, current_user.username)
+        window = int(time.time() // STATS_ETAG_WINDOW_SECONDS)
+        etag = http_cache.compute_etag("stats", current_user.username, version, days, window)
+        if http_cache.etag_matches(request.headers.get("if-none-match"), etag):
+            return http_cache.not_modified(etag)
+
+        # Aggregated in MongoDB; long windows read the daily rollups
+        payload = await stats.compute_user_stats(db, current_user.username, days)
+        return http_cache.json_response(request, payload, etag)
     except Exception as e:
         logger.error(f"Error getting user stats: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error getting user stats: {str(e)}")
 
-def get_most_common_activities(break_sessions):
-    activities = [session["activity"] for session in break_sessions]
-    activity_counts = {}
-    for activity in activities:
-        activity_counts[activity] = activity_counts.get(activity, 0) + 1
-    return sorted(activity_counts.items(), key=lambda x: x[1], reverse=True)[:5]
+# Open connections and create indexes before the first request: ping MongoDB
+# (the pool fills to MONGODB_MIN_POOL_SIZE in the background), start every
+# password hashing worker and open a keep-alive connection to the LLM API.
+# Failures are logged rather than fatal; /ready reports whether MongoDB is up.
+async def prewarm():
+    started = time.perf_counter()
+    try:
+        await db.command("ping")
+        await stats.ensure_indexes(db)
+        await history.ensure_indexes(db)
+        await ingest.ensure_indexes(db)
+        await buckets.ensure_indexes(db)
+        await buckets.detect(db)
+        await stats.detect(db)
+        await db.token_usage.create_index([("user_id", 1), ("day", -1), ("model", 1)], unique=True)
+        await db.profiles.create_index([("user_id", 1), ("_id", -1)])
+    except Exception as e:
+        logger.error(f"Error warming up MongoDB: {str(e)}")
+
+    try:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(password_executor, passwords.warm_up)
+            for _ in range(PASSWORD_HASH_WORKERS)
+        ))
+    except Exception as e:
+        logger.error(f"Error warming up password hashing workers: {str(e)}")
+
+    if OPENAI_PREWARM:
+        try:
+            await asyncio.wait_for(openai_client.models.list(), timeout=OPENAI_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.warning(f"Could not pre-warm the OpenAI connection: {str(e)}")
+
+    logger.info(f"Worker {os.getpid()} warmed up in {time.perf_counter() - started:.2f}s")
 
-# Run the application if this file is executed directly
+# Liveness probe: the process is up and serving
+@app.get("/health", include_in_schema=False)
+async def health():
+    return {"status": "ok"}
+
+# Readiness probe: startup warm-up has finished and MongoDB answers
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    if not app.state.ready:
+        raise HTTPException(status_code=503, detail="Starting up")
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=MONGODB_SERVER_SELECTION_TIMEOUT_MS / 1000)
+    except Exception as e:
+        logger.error(f"Readiness check failed: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {"status": "ready"}
+
+# Run the application if this file is executed directly. WEB_CONCURRENCY > 1
+# starts that many worker processes, each with its own connection pools and
+# caches; metrics from all of them are aggregated through
+# PROMETHEUS_MULTIPROC_DIR, which is created here when it isn't set.
 if __name__ == "__main__":
+    import tempfile
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WEB_CONCURRENCY > 1:
+        os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="breakbetter-metrics-"))
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=WEB_CONCURRENCY
+    )
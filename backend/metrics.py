@@ -0,0 +1,178 @@
+# Prometheus metrics for the BreakBetter API: per-route HTTP latency and
+# in-flight requests, MongoDB command timing, and OpenAI latency, token and
+# error counts. Exposed by main.py on /metrics.
+#
+# When running several worker processes, set PROMETHEUS_MULTIPROC_DIR to an
+# empty writable directory so every worker's samples are aggregated.
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+from starlette.routing import Match
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests currently being served",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+MONGODB_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command latency by collection and command",
+    ["collection", "command", "status"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+LLM_REQUEST_DURATION = Histogram(
+    "llm_request_duration_seconds",
+    "OpenAI chat completion latency, including client retries",
+    ["model", "mode", "outcome"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+LLM_PROMPT_TOKENS = Counter("llm_prompt_tokens_total", "Prompt tokens sent to OpenAI", ["model"])
+LLM_COMPLETION_TOKENS = Counter("llm_completion_tokens_total", "Completion tokens received from OpenAI", ["model"])
+LLM_ERRORS = Counter("llm_errors_total", "Failed OpenAI chat completions", ["model", "error"])
+LLM_HTTP_RESPONSES = Counter(
+    "llm_http_responses_total",
+    "HTTP responses from the OpenAI API, one per attempt",
+    ["status_code"],
+)
+LLM_RETRYABLE_RESPONSES = Counter(
+    "llm_retryable_responses_total",
+    "OpenAI responses the client retries (408, 409, 429, 5xx)",
+)
+LLM_POOL_IN_FLIGHT = Gauge(
+    "llm_pool_in_flight",
+    "Completions holding a slot in the bounded LLM pool",
+    multiprocess_mode="livesum",
+)
+LLM_POOL_WAITING = Gauge(
+    "llm_pool_waiting",
+    "Completions waiting for a slot in the bounded LLM pool",
+    multiprocess_mode="livesum",
+)
+LLM_RETRIES = Counter(
+    "llm_retries_total",
+    "OpenAI attempts retried, by whether the retry budget allowed it",
+    ["outcome"],
+)
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections_total",
+    "Requests rejected before reaching the LLM, by reason",
+    ["reason"],
+)
+RECOMMENDATION_CACHE_REQUESTS = Counter(
+    "recommendation_cache_requests_total",
+    "Recommendation lookups by who answered",
+    ["result"],
+)
+
+
+def render():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# Resolve the route template (e.g. /api/sessions/{session_id}/end) so
+# metrics aren't labelled with unbounded raw paths
+def _route_template(app, scope) -> str:
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+# Pure ASGI middleware recording latency and in-flight requests per route
+class MetricsMiddleware:
+    def __init__(self, app, fastapi_app):
+        self.app = app
+        self.fastapi_app = fastapi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = _route_template(self.fastapi_app, scope)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            HTTP_REQUEST_DURATION.labels(method, route, str(status_code)).observe(time.perf_counter() - started)
+
+
+# pymongo command listener timing every command by collection
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = "-"
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, status):
+        collection = self._collections.pop((event.connection_id, event.request_id), "-")
+        MONGODB_COMMAND_DURATION.labels(collection, event.command_name, status).observe(
+            event.duration_micros / 1_000_000
+        )
+
+    def succeeded(self, event):
+        self._finish(event, "success")
+
+    def failed(self, event):
+        self._finish(event, "failure")
+
+
+# httpx response hook for the OpenAI client: counts every attempt, so
+# retries show up as the gap between responses and completions
+async def record_llm_http_response(response):
+    LLM_HTTP_RESPONSES.labels(str(response.status_code)).inc()
+    if response.status_code in (408, 409, 429) or response.status_code >= 500:
+        LLM_RETRYABLE_RESPONSES.inc()
+
+
+def record_llm_call(model: str, mode: str, started: float, usage=None, completion_chunks: int = None, error: Exception = None):
+    outcome = "error" if error is not None else "success"
+    LLM_REQUEST_DURATION.labels(model, mode, outcome).observe(time.perf_counter() - started)
+    if error is not None:
+        LLM_ERRORS.labels(model, type(error).__name__).inc()
+    if usage is not None:
+        LLM_PROMPT_TOKENS.labels(model).inc(usage.prompt_tokens)
+        LLM_COMPLETION_TOKENS.labels(model).inc(usage.completion_tokens)
+    elif completion_chunks:
+        # Streamed completions don't report usage; each chunk is ~one token
+        LLM_COMPLETION_TOKENS.labels(model).inc(completion_chunks)
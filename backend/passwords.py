@@ -0,0 +1,24 @@
+# Password hashing helpers. Kept in their own lightweight module so the
+# process pool in main.py can import them without loading the whole app.
+import os
+from passlib.context import CryptContext
+
+# bcrypt cost factor; hashes made with a different cost are upgraded on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+# Returns (valid, new_hash); new_hash is set when the stored hash should be replaced
+def verify_and_update_password(plain_password, hashed_password):
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+def get_password_hash(password):
+    return pwd_context.hash(password)
+
+# Imports this module and loads the bcrypt backend in a pool worker; run at
+# startup so the first login doesn't pay for spawning the process
+def warm_up():
+    return pwd_context.handler("bcrypt").using(rounds=4).hash("warm-up")
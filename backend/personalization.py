@@ -0,0 +1,434 @@
+# Personalization model learned from session history. Session outcomes are
+# reduced to per-user sufficient statistics held in NumPy arrays:
+#   - energy change (after - before) by break activity and time of day
+#   - study sessions started / completed by planned interval and time of day
+# Cohort effects are the same statistics summed over all users. Per-user
+# parameters (best interval, activity bonus) shrink the user's own effects
+# towards the cohort's and are kept in a precomputed table, so a lookup is
+# O(1). The table is rebuilt from MongoDB in columnar batches and updated
+# incrementally as sessions end. One worker per host rebuilds it and shares
+# it with the others through a file.
+import asyncio
+import logging
+import os
+import re
+import socket
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import buckets
+import recommender
+
+logger = logging.getLogger(__name__)
+
+# Sessions that don't record the client's time of day count as "evening"
+# when they start at or after this UTC hour
+EVENING_HOUR = int(os.getenv("PERSONALIZATION_EVENING_HOUR", "17"))
+# How many sessions of cohort evidence a user's own effect is weighed against
+PRIOR_STRENGTH = float(os.getenv("PERSONALIZATION_PRIOR_STRENGTH", "5"))
+# Study sessions a user needs in a time slot before their interval is personalized
+MIN_STUDY_SESSIONS = int(os.getenv("PERSONALIZATION_MIN_STUDY_SESSIONS", "5"))
+# Most the profile-derived interval is moved when the learned one doesn't replace it
+MAX_INTERVAL_ADJUSTMENT = int(os.getenv("PERSONALIZATION_MAX_INTERVAL_ADJUSTMENT", "5"))
+# Completion rates below / above which that interval is shortened / lengthened
+LOW_COMPLETION_RATE = float(os.getenv("PERSONALIZATION_LOW_COMPLETION_RATE", "0.5"))
+HIGH_COMPLETION_RATE = float(os.getenv("PERSONALIZATION_HIGH_COMPLETION_RATE", "0.9"))
+# A study session counts as completed when it ran this share of its plan
+COMPLETION_RATIO = float(os.getenv("PERSONALIZATION_COMPLETION_RATIO", "0.8"))
+# Open study sessions older than this are counted as abandoned on rebuild
+ABANDONED_AFTER_HOURS = float(os.getenv("PERSONALIZATION_ABANDONED_AFTER_HOURS", "6"))
+# Score added to an activity per point of expected energy gain
+ENERGY_WEIGHT = float(os.getenv("PERSONALIZATION_ENERGY_WEIGHT", "0.3"))
+LOAD_BATCH_SIZE = int(os.getenv("PERSONALIZATION_LOAD_BATCH_SIZE", "50000"))
+# Where this host's rebuilt model is written for the other workers, and how
+# often they check it for a newer one
+MODEL_PATH = os.getenv(
+    "PERSONALIZATION_MODEL_PATH", os.path.join(tempfile.gettempdir(), "breakbetter_personalization.npz")
+)
+POLL_SECONDS = float(os.getenv("PERSONALIZATION_POLL_SECONDS", "30"))
+
+TIME_SLOTS = ["morning", "evening"]
+INTERVAL_MINUTES = np.arange(15, 55, 5)
+ACTIVITY_INDEX = {a["activity"]: i for i, a in enumerate(recommender.ACTIVITY_CATALOG)}
+
+_SLOTS = len(TIME_SLOTS)
+_SLOT_INDEX = {time_of_day: i for i, time_of_day in enumerate(TIME_SLOTS)}
+_INTERVALS = len(INTERVAL_MINUTES)
+_ACTIVITIES = len(ACTIVITY_INDEX)
+_MINUTES_PATTERN = re.compile(r"\d+")
+_USER_ARRAYS = (
+    "energy_sum", "energy_count", "study_completed", "study_total",
+    "interval_minutes", "interval_rate", "interval_adjustment", "activity_bonus"
+)
+_COHORT_ARRAYS = (
+    "cohort_energy_sum", "cohort_energy_count", "cohort_study_completed", "cohort_study_total"
+)
+
+
+def time_slot(moment: datetime) -> int:
+    return int(moment.hour >= EVENING_HOUR)
+
+def time_slots(hours: np.ndarray) -> np.ndarray:
+    return (hours >= EVENING_HOUR).astype(int)
+
+# Slot sessions on the client's time of day recorded at start (the same
+# value recommendations are looked up with), falling back to the UTC hour
+def session_slot(session: dict) -> int:
+    slot = _SLOT_INDEX.get(session.get("time_of_day"))
+    return time_slot(session["start_time"]) if slot is None else slot
+
+def session_slots(hours: np.ndarray, times_of_day: list) -> np.ndarray:
+    slots = time_slots(hours)
+    recorded = np.array([_SLOT_INDEX.get(t, -1) for t in times_of_day], dtype=int)
+    return np.where(recorded >= 0, recorded, slots)
+
+# Planned minutes from a study_interval such as "25 minutes"; None if unknown
+def planned_minutes(study_interval) -> int:
+    match = _MINUTES_PATTERN.search(str(study_interval or ""))
+    return int(match.group()) if match else None
+
+# Plain lists iterate much faster than NumPy string arrays in dict lookups
+def _as_list(values) -> list:
+    return values.tolist() if isinstance(values, np.ndarray) else values
+
+def interval_bucket(minutes) -> np.ndarray:
+    return np.clip(np.rint((np.asarray(minutes, dtype=float) - INTERVAL_MINUTES[0]) / 5), 0, _INTERVALS - 1).astype(int)
+
+
+class PersonalizationModel:
+    def __init__(self, capacity: int = 1024):
+        self.users = {}
+        self._allocate(capacity)
+        # Cohort statistics: the per-user ones summed over every user
+        self.cohort_energy_sum = np.zeros((_SLOTS, _ACTIVITIES))
+        self.cohort_energy_count = np.zeros((_SLOTS, _ACTIVITIES))
+        self.cohort_study_completed = np.zeros((_SLOTS, _INTERVALS))
+        self.cohort_study_total = np.zeros((_SLOTS, _INTERVALS))
+        self.sessions = 0
+
+    def _allocate(self, capacity: int):
+        self.energy_sum = np.zeros((capacity, _SLOTS, _ACTIVITIES))
+        self.energy_count = np.zeros((capacity, _SLOTS, _ACTIVITIES))
+        self.study_completed = np.zeros((capacity, _SLOTS, _INTERVALS))
+        self.study_total = np.zeros((capacity, _SLOTS, _INTERVALS))
+        # Precomputed parameter table
+        self.interval_minutes = np.zeros((capacity, _SLOTS), dtype=int)
+        self.interval_rate = np.zeros((capacity, _SLOTS, _INTERVALS))
+        self.interval_adjustment = np.zeros((capacity, _SLOTS), dtype=int)
+        self.activity_bonus = np.zeros((capacity, _SLOTS, _ACTIVITIES))
+
+    def _grow(self, needed: int):
+        capacity = len(self.energy_sum)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        arrays = {name: getattr(self, name) for name in _USER_ARRAYS}
+        self._allocate(capacity)
+        for name, old in arrays.items():
+            getattr(self, name)[:len(old)] = old
+
+    # Row indexes for a column of user ids, registering new users
+    def _rows(self, user_ids) -> np.ndarray:
+        users = self.users
+        user_ids = _as_list(user_ids)
+        rows = [users.get(user_id) for user_id in user_ids]
+        if None in rows:
+            for i, row in enumerate(rows):
+                if row is None:
+                    rows[i] = users.setdefault(user_ids[i], len(users))
+            self._grow(len(users))
+        return np.array(rows, dtype=int)
+
+    # Accumulate a batch of finished breaks given as columns
+    def add_breaks(self, user_ids, slots, activities, energy_deltas):
+        activity_ids = np.array([ACTIVITY_INDEX.get(a, -1) for a in _as_list(activities)], dtype=int)
+        known = activity_ids >= 0
+        if not known.any():
+            return
+        rows = self._rows(np.asarray(user_ids)[known])
+        slots, activity_ids = np.asarray(slots, dtype=int)[known], activity_ids[known]
+        deltas = np.asarray(energy_deltas, dtype=float)[known]
+        np.add.at(self.energy_sum, (rows, slots, activity_ids), deltas)
+        np.add.at(self.energy_count, (rows, slots, activity_ids), 1)
+        np.add.at(self.cohort_energy_sum, (slots, activity_ids), deltas)
+        np.add.at(self.cohort_energy_count, (slots, activity_ids), 1)
+        self.sessions += int(known.sum())
+
+    # Accumulate a batch of study sessions given as columns (completed is a
+    # boolean array: ran at least COMPLETION_RATIO of the planned minutes)
+    def add_study_sessions(self, user_ids, slots, planned, completed):
+        if len(user_ids) == 0:
+            return
+        rows = self._rows(np.asarray(user_ids))
+        slots, buckets = np.asarray(slots, dtype=int), interval_bucket(planned)
+        completed = np.asarray(completed, dtype=float)
+        np.add.at(self.study_total, (rows, slots, buckets), 1)
+        np.add.at(self.study_completed, (rows, slots, buckets), completed)
+        np.add.at(self.cohort_study_total, (slots, buckets), 1)
+        np.add.at(self.cohort_study_completed, (slots, buckets), completed)
+        self.sessions += len(user_ids)
+
+    # Write the model to `path` atomically, so readers never see a partial file
+    def save(self, path: str):
+        count = len(self.users)
+        users = sorted(self.users, key=self.users.get)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            np.savez(
+                f,
+                users=np.array(users, dtype=str),
+                sessions=self.sessions,
+                **{name: getattr(self, name)[:count] for name in _USER_ARRAYS},
+                **{name: getattr(self, name) for name in _COHORT_ARRAYS}
+            )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PersonalizationModel":
+        with np.load(path) as data:
+            users = data["users"].tolist()
+            model = cls(max(len(users), 1))
+            model.users = {user_id: row for row, user_id in enumerate(users)}
+            model.sessions = int(data["sessions"])
+            for name in _USER_ARRAYS:
+                getattr(model, name)[:len(users)] = data[name]
+            for name in _COHORT_ARRAYS:
+                setattr(model, name, data[name])
+        return model
+
+    # Recompute the parameter table for the given rows (all users by default)
+    def refresh(self, rows=None):
+        if not self.users:
+            return
+        rows = np.arange(len(self.users)) if rows is None else np.asarray(rows, dtype=int)
+
+        # Cohort effects; completion rates are Laplace-smoothed so intervals
+        # nobody has tried sit at 0.5
+        cohort_mean = np.divide(
+            self.cohort_energy_sum, self.cohort_energy_count,
+            out=np.zeros_like(self.cohort_energy_sum), where=self.cohort_energy_count > 0
+        )
+        cohort_rate = (self.cohort_study_completed + 1) / (self.cohort_study_total + 2)
+
+        # Users' effects shrunk towards their cohort's
+        energy = (self.energy_sum[rows] + PRIOR_STRENGTH * cohort_mean) / (self.energy_count[rows] + PRIOR_STRENGTH)
+        self.activity_bonus[rows] = ENERGY_WEIGHT * energy
+
+        total = self.study_total[rows]
+        rate = (self.study_completed[rows] + PRIOR_STRENGTH * cohort_rate) / (total + PRIOR_STRENGTH)
+        self.interval_rate[rows] = rate
+        # The tried interval with the most expected focused minutes is only a
+        # candidate when the user has tried at least two intervals
+        focused = np.where(total > 0, INTERVAL_MINUTES * rate, -np.inf)
+        best = INTERVAL_MINUTES[np.argmax(focused, axis=-1)]
+        enough = total.sum(axis=-1) >= MIN_STUDY_SESSIONS
+        compared = (total > 0).sum(axis=-1) >= 2
+        self.interval_minutes[rows] = np.where(enough & compared, best, 0)
+
+        # Otherwise the user's overall completion rate nudges the profile's
+        # interval: shorter if they rarely finish, longer if they nearly always do
+        cohort_completion = (self.cohort_study_completed.sum(axis=-1) + 1) / (self.cohort_study_total.sum(axis=-1) + 2)
+        completion = (self.study_completed[rows].sum(axis=-1) + PRIOR_STRENGTH * cohort_completion) / (
+            total.sum(axis=-1) + PRIOR_STRENGTH
+        )
+        adjustment = np.where(
+            completion < LOW_COMPLETION_RATE, -MAX_INTERVAL_ADJUSTMENT,
+            np.where(completion > HIGH_COMPLETION_RATE, MAX_INTERVAL_ADJUSTMENT, 0)
+        )
+        self.interval_adjustment[rows] = np.where(enough, adjustment, 0)
+
+    # Incremental updates as sessions end
+    def observe_break(self, session: dict):
+        if session.get("energy_level_after") is None or session.get("activity") not in ACTIVITY_INDEX:
+            return
+        self.add_breaks(
+            [session["user_id"]],
+            [session_slot(session)],
+            [session["activity"]],
+            [session["energy_level_after"] - session["energy_level_before"]]
+        )
+        self.refresh([self.users[session["user_id"]]])
+
+    def observe_study_session(self, session: dict):
+        planned = planned_minutes(session.get("study_interval"))
+        if planned is None or session.get("end_time") is None:
+            return
+        minutes = (session["end_time"] - session["start_time"]).total_seconds() / 60
+        self.add_study_sessions(
+            [session["user_id"]],
+            [session_slot(session)],
+            [planned],
+            [minutes >= COMPLETION_RATIO * planned]
+        )
+        self.refresh([self.users[session["user_id"]]])
+
+    # O(1) lookups from the parameter table. None when there is nothing
+    # personal to say for this user and time of day.
+    #
+    # The learned interval replaces `baseline` (the profile-derived minutes)
+    # only when it is expected to give more focused minutes; otherwise the
+    # baseline is moved by at most MAX_INTERVAL_ADJUSTMENT.
+    def study_interval(self, user_id: str, time_of_day: str, baseline: int):
+        row = self.users.get(user_id)
+        if row is None or time_of_day not in TIME_SLOTS:
+            return None
+        slot = TIME_SLOTS.index(time_of_day)
+        best = int(self.interval_minutes[row, slot])
+        rates = self.interval_rate[row, slot]
+        if best and best != baseline and best * rates[interval_bucket(best)] > baseline * rates[interval_bucket(baseline)]:
+            return best
+        adjustment = int(self.interval_adjustment[row, slot])
+        if not adjustment:
+            return None
+        minutes = int(np.clip(baseline + adjustment, INTERVAL_MINUTES[0], INTERVAL_MINUTES[-1]))
+        return minutes if minutes != baseline else None
+
+    def activity_scores(self, user_id: str, time_of_day: str):
+        row = self.users.get(user_id)
+        if row is None or time_of_day not in TIME_SLOTS:
+            return None
+        return self.activity_bonus[row, TIME_SLOTS.index(time_of_day)]
+
+
+def _columns(docs: list, *fields) -> list:
+    return [[doc.get(field) for doc in docs] for field in fields]
+
+# UTC hour of each start time. Reading the attribute is much faster than
+# converting a list of datetimes to datetime64.
+def _hours(start_times: list) -> np.ndarray:
+    return np.fromiter((moment.hour for moment in start_times), dtype=int, count=len(start_times))
+
+# Build a model from all session history, reading each collection in large
+# projected batches and folding every batch in with vectorized updates
+async def build_model(db, batch_size: int = LOAD_BATCH_SIZE) -> PersonalizationModel:
+    started = time.perf_counter()
+    model = PersonalizationModel()
+
+    break_fields = ["start_time", "time_of_day", "activity", "energy_level_before", "energy_level_after"]
+    breaks = db.break_sessions.find(
+        {"completed": True, "energy_level_after": {"$ne": None}},
+        {"_id": 0, "user_id": 1, **{field: 1 for field in break_fields}}
+    ).batch_size(batch_size)
+    await _load(model, _add_break_batch, breaks, batch_size)
+    await _load(
+        model, _add_break_batch,
+        (doc async for doc in _bucketed_sessions(db, "break", break_fields) if doc.get("energy_level_after") is not None),
+        batch_size
+    )
+
+    study_fields = ["start_time", "time_of_day", "end_time", "study_interval", "completed"]
+    abandoned_before = datetime.utcnow() - timedelta(hours=ABANDONED_AFTER_HOURS)
+    studies = db.study_sessions.find(
+        {"$or": [{"completed": True}, {"start_time": {"$lt": abandoned_before}}]},
+        {"_id": 0, "user_id": 1, **{field: 1 for field in study_fields}}
+    ).batch_size(batch_size)
+    await _load(model, _add_study_batch, studies, batch_size)
+    await _load(model, _add_study_batch, _bucketed_sessions(db, "study", study_fields), batch_size)
+
+    await asyncio.to_thread(model.refresh)
+    logger.info(
+        f"Personalization model built from {model.sessions} sessions of "
+        f"{len(model.users)} users in {time.perf_counter() - started:.2f}s"
+    )
+    return model
+
+# Batches are folded into the model on a worker thread so requests keep
+# being served while it builds
+async def _load(model: PersonalizationModel, add_batch, docs, batch_size: int):
+    batch = []
+    async for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            await asyncio.to_thread(add_batch, model, batch)
+            batch = []
+    await asyncio.to_thread(add_batch, model, batch)
+
+# Sessions compacted into buckets that are still in MongoDB. Archived
+# buckets are left out, so the model learns from the last
+# SESSION_ARCHIVE_AFTER_DAYS of history.
+async def _bucketed_sessions(db, kind: str, fields: list):
+    buckets = db.session_buckets.find(
+        {"kind": kind, "archived": False},
+        {"_id": 0, "user_id": 1, **{f"sessions.{field}": 1 for field in fields}}
+    )
+    async for bucket in buckets:
+        for session in bucket["sessions"]:
+            session["user_id"] = bucket["user_id"]
+            yield session
+
+def _add_break_batch(model: PersonalizationModel, batch: list):
+    if not batch:
+        return
+    user_ids, start_times, times_of_day, activities, before, after = _columns(
+        batch, "user_id", "start_time", "time_of_day", "activity", "energy_level_before", "energy_level_after"
+    )
+    model.add_breaks(
+        np.array(user_ids),
+        session_slots(_hours(start_times), times_of_day),
+        activities,
+        np.array(after, dtype=float) - np.array(before, dtype=float)
+    )
+
+def _add_study_batch(model: PersonalizationModel, batch: list):
+    if not batch:
+        return
+    user_ids, start_times, times_of_day, end_times, intervals, completed = _columns(
+        batch, "user_id", "start_time", "time_of_day", "end_time", "study_interval", "completed"
+    )
+    # Parse each distinct study_interval string once
+    parsed = {}
+    for interval in set(intervals):
+        parsed[interval] = planned_minutes(interval) or 0
+    planned = np.array([parsed[interval] for interval in intervals], dtype=float)
+    minutes = np.fromiter(
+        ((end - start).total_seconds() / 60 if end else 0.0 for start, end in zip(start_times, end_times)),
+        dtype=float, count=len(start_times)
+    )
+    ran_long_enough = np.array(completed, dtype=bool) & (minutes >= COMPLETION_RATIO * planned)
+
+    known = planned > 0
+    model.add_study_sessions(
+        np.array(user_ids)[known],
+        session_slots(_hours(start_times), times_of_day)[known],
+        planned[known],
+        ran_long_enough[known]
+    )
+
+# Rebuild the model now and then so every worker picks up sessions that
+# ended on other workers; `apply` receives each new model. The worker holding
+# this host's lease rebuilds it every `interval` seconds and saves it to
+# `path`; the others load it from there when it changes.
+async def refresh_periodically(db, apply, interval: float, path: str = MODEL_PATH, poll: float = POLL_SECONDS):
+    lease = f"personalization:{socket.gethostname()}"
+    loaded = None
+    while True:
+        try:
+            if await buckets.acquire_lease(db, lease, interval):
+                model = await build_model(db)
+                await asyncio.to_thread(model.save, path)
+                loaded = os.path.getmtime(path)
+                apply(model)
+            elif os.path.exists(path) and os.path.getmtime(path) != loaded:
+                loaded = os.path.getmtime(path)
+                apply(await asyncio.to_thread(PersonalizationModel.load, path))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error refreshing personalization model: {str(e)}")
+        await asyncio.sleep(min(poll, interval))
+
+
+# Build the model from the command line and report how long it took:
+# python personalization.py
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv("MONGODB_URL"))
+    asyncio.run(build_model(client.breakbetter))
@@ -0,0 +1,85 @@
+# Predictive precomputation of each user's next recommendation. Session
+# events (a study session ending, a break starting) schedule a background
+# job per user; its result sits in a short-lived per-user slot that
+# /api/recommend serves when the incoming profile has the same fingerprint.
+import asyncio
+import logging
+import os
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+PRECOMPUTE_TTL_SECONDS = float(os.getenv("PRECOMPUTE_TTL_SECONDS", "900"))
+PRECOMPUTE_MAX_WORKERS = int(os.getenv("PRECOMPUTE_MAX_WORKERS", "4"))
+PRECOMPUTE_MAX_PENDING = int(os.getenv("PRECOMPUTE_MAX_PENDING", "1000"))
+
+
+class Precomputer:
+    def __init__(
+        self,
+        max_workers: int = PRECOMPUTE_MAX_WORKERS,
+        max_pending: int = PRECOMPUTE_MAX_PENDING,
+        ttl: float = PRECOMPUTE_TTL_SECONDS,
+        maxsize: int = 10000
+    ):
+        self.max_pending = max_pending
+        self.slots = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.tasks = {}
+        self._workers = asyncio.Semaphore(max_workers)
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+
+    # Start precomputing for a user. `compute` is an async callable returning
+    # (fingerprint, recommendation), or None when there is nothing to predict.
+    # A newer event supersedes the user's in-flight job, which is cancelled.
+    def schedule(self, username: str, compute) -> bool:
+        self.cancel(username)
+        if len(self.tasks) >= self.max_pending:
+            self.dropped += 1
+            logger.warning("Precompute queue full, skipping prediction")
+            return False
+        self.tasks[username] = asyncio.create_task(self._run(username, compute))
+        return True
+
+    async def _run(self, username: str, compute):
+        try:
+            async with self._workers:
+                result = await compute()
+            if result is not None:
+                self.slots.set(username, result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Precompute failed: {str(e)}")
+        finally:
+            if self.tasks.get(username) is asyncio.current_task():
+                del self.tasks[username]
+
+    # The precomputed recommendation for this user, if it was made for an
+    # equivalent profile and hasn't expired
+    def get(self, username: str, fingerprint: str):
+        slot = self.slots.get(username)
+        if slot is not None and slot[0] == fingerprint:
+            self.hits += 1
+            return slot[1]
+        self.misses += 1
+        return None
+
+    def cancel(self, username: str):
+        task = self.tasks.pop(username, None)
+        if task is not None:
+            task.cancel()
+
+    # Drop a user's job and slot, e.g. when their stored profile changes
+    def invalidate(self, username: str):
+        self.cancel(username)
+        self.slots.pop(username)
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
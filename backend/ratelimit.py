@@ -0,0 +1,105 @@
+# Admission control for the recommendation endpoints: token buckets held in
+# a pluggable store (per user and global), and a retry budget that caps how
+# many LLM retries may be spent relative to first attempts.
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", "30"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "10"))
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "50"))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "200"))
+
+
+# Interface for bucket stores. take() returns 0 when `cost` tokens were
+# taken, otherwise the seconds until they would be available; refund()
+# returns tokens taken for a request that was rejected further on.
+class BucketStore(ABC):
+    @abstractmethod
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        ...
+
+    @abstractmethod
+    def refund(self, key: str, burst: float, cost: float = 1):
+        ...
+
+
+# In-process store: buckets live in this worker's memory (limits apply per
+# worker) and the least recently used ones are dropped beyond `maxsize`
+class LocalBucketStore(BucketStore):
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        # A request larger than the bucket can still pass once it is full
+        cost = min(cost, burst)
+        if tokens >= cost:
+            tokens -= cost
+            wait = 0.0
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def refund(self, key: str, burst: float, cost: float = 1):
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets[key] = (min(burst, bucket[0] + cost), bucket[1])
+
+
+# Per-user and global token buckets. admit() charges `cost` tokens (e.g.
+# the LLM calls a batch may make) to both, each capped at its burst, and
+# returns None when the request may proceed, otherwise
+# (scope, retry_after_seconds) with scope "user" or "global".
+class RateLimiter:
+    def __init__(
+        self,
+        store: BucketStore,
+        user_per_minute: float = RATE_LIMIT_USER_PER_MINUTE,
+        user_burst: float = RATE_LIMIT_USER_BURST,
+        global_per_second: float = RATE_LIMIT_GLOBAL_PER_SECOND,
+        global_burst: float = RATE_LIMIT_GLOBAL_BURST
+    ):
+        self.store = store
+        self.user_rate = user_per_minute / 60
+        self.user_burst = user_burst
+        self.global_rate = global_per_second
+        self.global_burst = global_burst
+
+    def admit(self, username: str, cost: float = 1):
+        user_key = f"user:{username}"
+        wait = self.store.take(user_key, self.user_rate, self.user_burst, cost)
+        if wait:
+            return "user", wait
+        wait = self.store.take("global", self.global_rate, self.global_burst, cost)
+        if wait:
+            self.store.refund(user_key, self.user_burst, cost)
+            return "global", wait
+        return None
+
+
+# Retry budget: every first attempt deposits `ratio` tokens (up to
+# `max_tokens`) and every retry spends one, so retries stay a bounded share
+# of traffic and can't multiply load while the upstream is struggling
+class RetryBudget:
+    def __init__(self, ratio: float = 0.1, max_tokens: float = 10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
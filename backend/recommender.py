@@ -0,0 +1,255 @@
+# Local rule-based recommendation engine. Scores a catalog of break
+# activities against a normalized profile in one vectorized pass, so it can
+# answer in well under a millisecond when the LLM is slow, down or not wanted.
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Break activity catalog. Each entry is tagged with how it relates to the
+# profile features the engine scores on:
+#   screen_free - gives the eyes a rest from screens
+#   movement    - 0 (still) to 1 (vigorous); good after sedentary study
+#   energizing  - lifts low energy; calming activities score negative
+#   min/max     - comfortable duration range in minutes
+#   tags        - preference tokens the activity matches
+ACTIVITY_CATALOG = [
+    {
+        "activity": "Take a brisk walk outside",
+        "description": "Step outside for a brisk walk. Fresh air and light movement boost circulation and reset your attention.",
+        "screen_free": 1, "movement": 0.8, "energizing": 0.8, "min": 5, "max": 30,
+        "tags": {"walking", "walk", "outdoors", "nature", "exercise", "fresh air"},
+        "benefits": ["Boosts circulation", "Restores attention", "Lifts energy"],
+    },
+    {
+        "activity": "Do a short stretching routine",
+        "description": "Stretch your neck, shoulders, back and legs, holding each stretch for 20-30 seconds.",
+        "screen_free": 1, "movement": 0.5, "energizing": 0.4, "min": 3, "max": 15,
+        "tags": {"stretching", "yoga", "exercise", "mobility"},
+        "benefits": ["Releases muscle tension", "Improves posture", "Reduces fatigue"],
+    },
+    {
+        "activity": "Practice guided breathing",
+        "description": "Sit comfortably and breathe in for 4 seconds, hold for 4, and out for 6. Repeat for a few minutes.",
+        "screen_free": 1, "movement": 0.0, "energizing": -0.6, "min": 2, "max": 10,
+        "tags": {"meditation", "mindfulness", "breathing", "relaxation", "calm"},
+        "benefits": ["Lowers stress", "Calms the mind", "Sharpens focus"],
+    },
+    {
+        "activity": "Meditate quietly",
+        "description": "Close your eyes and focus on your breath or a simple mantra, letting thoughts pass without judgement.",
+        "screen_free": 1, "movement": 0.0, "energizing": -0.5, "min": 5, "max": 20,
+        "tags": {"meditation", "mindfulness", "relaxation", "calm", "quiet"},
+        "benefits": ["Reduces anxiety", "Improves emotional balance", "Restores focus"],
+    },
+    {
+        "activity": "Do a quick bodyweight workout",
+        "description": "Run through a short circuit of squats, push-ups and jumping jacks to get your heart rate up.",
+        "screen_free": 1, "movement": 1.0, "energizing": 1.0, "min": 5, "max": 20,
+        "tags": {"exercise", "workout", "fitness", "sports", "gym"},
+        "benefits": ["Raises alertness", "Improves mood", "Counters sitting"],
+    },
+    {
+        "activity": "Listen to your favourite music",
+        "description": "Put on a few songs you enjoy, ideally with your eyes closed or looking away from the screen.",
+        "screen_free": 1, "movement": 0.1, "energizing": 0.3, "min": 3, "max": 20,
+        "tags": {"music", "listening", "songs", "relaxation"},
+        "benefits": ["Improves mood", "Reduces stress", "Provides a mental reset"],
+    },
+    {
+        "activity": "Dance to a couple of songs",
+        "description": "Play two or three upbeat songs and dance along to shake off tension.",
+        "screen_free": 1, "movement": 0.9, "energizing": 0.9, "min": 5, "max": 15,
+        "tags": {"music", "dancing", "dance", "exercise"},
+        "benefits": ["Lifts energy", "Improves mood", "Gets you moving"],
+    },
+    {
+        "activity": "Have a healthy snack and a glass of water",
+        "description": "Step away from your desk for water and a light snack such as fruit or nuts.",
+        "screen_free": 1, "movement": 0.2, "energizing": 0.5, "min": 5, "max": 20,
+        "tags": {"food", "snack", "cooking", "eating", "tea", "coffee"},
+        "benefits": ["Refuels the brain", "Keeps you hydrated", "Stabilizes energy"],
+    },
+    {
+        "activity": "Make a cup of tea",
+        "description": "Brew a cup of tea away from your desk and enjoy it slowly without screens.",
+        "screen_free": 1, "movement": 0.2, "energizing": 0.1, "min": 5, "max": 15,
+        "tags": {"tea", "coffee", "relaxation", "calm"},
+        "benefits": ["Provides a calm pause", "Keeps you hydrated", "Eases tension"],
+    },
+    {
+        "activity": "Read a few pages of a book",
+        "description": "Read something unrelated to your studies from a printed book or magazine.",
+        "screen_free": 1, "movement": 0.0, "energizing": -0.1, "min": 10, "max": 30,
+        "tags": {"reading", "books", "quiet"},
+        "benefits": ["Rests working memory", "Reduces stress", "Keeps eyes off screens"],
+    },
+    {
+        "activity": "Doodle or sketch",
+        "description": "Grab a pen and paper and sketch whatever comes to mind for a few minutes.",
+        "screen_free": 1, "movement": 0.0, "energizing": 0.1, "min": 5, "max": 20,
+        "tags": {"drawing", "art", "creative", "sketching", "doodling"},
+        "benefits": ["Engages a different part of the brain", "Sparks creativity", "Reduces stress"],
+    },
+    {
+        "activity": "Take a power nap",
+        "description": "Lie down and rest for 10-20 minutes; set an alarm so you don't sleep too deeply.",
+        "screen_free": 1, "movement": 0.0, "energizing": 0.6, "min": 10, "max": 25,
+        "tags": {"sleep", "nap", "rest"},
+        "benefits": ["Restores alertness", "Improves memory consolidation", "Reduces fatigue"],
+    },
+    {
+        "activity": "Tidy up your study space",
+        "description": "Spend a few minutes clearing your desk and organizing your materials for the next session.",
+        "screen_free": 1, "movement": 0.4, "energizing": 0.3, "min": 5, "max": 15,
+        "tags": {"cleaning", "organizing", "tidying"},
+        "benefits": ["Reduces distractions", "Gives a sense of progress", "Gets you moving"],
+    },
+    {
+        "activity": "Call or chat with a friend",
+        "description": "Have a quick, lighthearted conversation with a friend or family member.",
+        "screen_free": 0, "movement": 0.1, "energizing": 0.4, "min": 5, "max": 20,
+        "tags": {"social", "friends", "talking", "family"},
+        "benefits": ["Improves mood", "Reduces isolation", "Provides a mental reset"],
+    },
+    {
+        "activity": "Play a short puzzle game",
+        "description": "Play a quick word or logic puzzle to switch contexts without losing momentum.",
+        "screen_free": 0, "movement": 0.0, "energizing": 0.2, "min": 3, "max": 10,
+        "tags": {"games", "gaming", "puzzles", "video games"},
+        "benefits": ["Provides a playful reset", "Keeps the mind engaged", "Improves mood"],
+    },
+    {
+        "activity": "Do the 20-20-20 eye exercise",
+        "description": "Look at something about 20 feet away for 20 seconds, then close your eyes and roll them gently. Repeat a few times.",
+        "screen_free": 1, "movement": 0.0, "energizing": 0.0, "min": 1, "max": 5,
+        "tags": {"eyes", "rest"},
+        "benefits": ["Reduces eye strain", "Relaxes focusing muscles", "Prevents headaches"],
+    },
+]
+
+# Feature matrix for the catalog: one row per activity, built once at import
+_SCREEN_FREE = np.array([a["screen_free"] for a in ACTIVITY_CATALOG], dtype=float)
+_MOVEMENT = np.array([a["movement"] for a in ACTIVITY_CATALOG], dtype=float)
+_ENERGIZING = np.array([a["energizing"] for a in ACTIVITY_CATALOG], dtype=float)
+_MIN_DURATION = np.array([a["min"] for a in ACTIVITY_CATALOG], dtype=float)
+_MAX_DURATION = np.array([a["max"] for a in ACTIVITY_CATALOG], dtype=float)
+_TAG_VOCABULARY = sorted(set().union(*(a["tags"] for a in ACTIVITY_CATALOG)))
+_TAG_INDEX = {tag: i for i, tag in enumerate(_TAG_VOCABULARY)}
+_TAGS = np.zeros((len(ACTIVITY_CATALOG), len(_TAG_VOCABULARY)))
+for row, activity in enumerate(ACTIVITY_CATALOG):
+    for tag in activity["tags"]:
+        _TAGS[row, _TAG_INDEX[tag]] = 1.0
+
+_ENERGY_TARGET = {"low": 0.7, "medium": 0.2, "high": -0.3}
+
+def _preference_vector(preferences) -> np.ndarray:
+    vector = np.zeros(len(_TAG_VOCABULARY))
+    for preference in preferences:
+        index = _TAG_INDEX.get(preference)
+        if index is None:
+            # Loose match so "walks" or "classical music" still hit their tag
+            matches = [i for tag, i in _TAG_INDEX.items() if tag in preference or preference in tag]
+            vector[matches] = 1.0
+        else:
+            vector[index] = 1.0
+    return vector
+
+# Score every catalog activity against a normalized profile (see
+# main.normalize_profile) and return the scores as an array
+def score_activities(features: dict) -> np.ndarray:
+    duration = features["preferred_break_duration"]
+    scores = 2.0 * (_TAGS @ _preference_vector(features["personal_preferences"]))
+    if features["screen_usage"]:
+        scores += 1.5 * _SCREEN_FREE
+    if features["activity_level"] == "sedentary":
+        scores += 1.2 * _MOVEMENT
+    else:
+        scores -= 0.6 * _MOVEMENT
+    # Prefer activities whose energizing effect matches what the user needs
+    scores -= np.abs(_ENERGIZING - _ENERGY_TARGET.get(features["energy_band"], 0.2))
+    # Penalize activities that don't fit the preferred duration
+    scores -= 0.1 * (np.maximum(0, _MIN_DURATION - duration) + np.maximum(0, duration - _MAX_DURATION))
+    return scores
+
+def _study_tips(features: dict) -> list:
+    tips = []
+    if features["study_interval"] == "high_mental":
+        tips.append("Tackle the hardest material at the start of each interval")
+    else:
+        tips.append("Batch similar low-effort tasks together to keep momentum")
+    if features["deadline_pressure"] == "high":
+        tips.append("Write down the single most important goal for the next interval")
+    else:
+        tips.append("Review what you covered before starting the next interval")
+    if features["time_of_day"] == "evening":
+        tips.append("Dim bright screens and avoid caffeine to protect your sleep")
+    else:
+        tips.append("Use your morning focus for active recall and practice problems")
+    return tips
+
+# Build a BreakRecommendation-shaped dict from the best-scoring activity.
+# `bonus` adds per-activity scores, e.g. from the personalization model.
+def recommend(features: dict, study_interval: str, bonus: np.ndarray = None) -> dict:
+    scores = score_activities(features)
+    if bonus is not None:
+        scores = scores + bonus
+    best = ACTIVITY_CATALOG[int(np.argmax(scores))]
+    duration = int(min(max(features["preferred_break_duration"], best["min"]), best["max"]))
+    return {
+        "study_interval": study_interval,
+        "break_activity": best["activity"],
+        "duration": duration,
+        "description": best["description"],
+        "benefits": list(best["benefits"]),
+        "study_tips": _study_tips(features),
+        "source": "local",
+    }
+
+
+# Circuit breaker around the LLM. After `failure_threshold` consecutive
+# failures it opens and callers go straight to the local engine; after
+# `reset_timeout` seconds one trial call is let through (half-open).
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        # Let one trial call through; if it never reports back (e.g. it was
+        # cancelled), allow another once reset_timeout has passed again
+        now = time.monotonic()
+        if state == "half_open" and (self.trial_started_at is None or now - self.trial_started_at >= self.reset_timeout):
+            self.trial_started_at = now
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("LLM circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_started_at = None
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"LLM circuit breaker opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
@@ -0,0 +1,333 @@
+# Statistics helpers: MongoDB aggregation pipelines over raw sessions plus
+# per-user daily rollups that are updated incrementally as sessions end.
+# Sessions compacted into buckets (see buckets.py) are read alongside the
+# raw ones. Sessions that ended before the rollups were deployed are only
+# in them after a backfill (python stats.py), so they are read only after
+# that (see rollups_enabled).
+import asyncio
+import os
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+
+import buckets
+
+# Windows at least this many days long are served from the daily rollups
+STATS_ROLLUP_MIN_DAYS = int(os.getenv("STATS_ROLLUP_MIN_DAYS", "14"))
+# Whether the rollups are complete; set at startup by detect()
+rollups_enabled = False
+
+# Rollups are keyed on the UTC day a session started
+def day_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, moment.day)
+
+def session_minutes(session: dict) -> float:
+    return (session["end_time"] - session["start_time"]).total_seconds() / 60
+
+# Create the indexes the stats and rollup queries rely on
+async def ensure_indexes(db):
+    session_index = IndexModel(
+        [("user_id", ASCENDING), ("completed", ASCENDING), ("start_time", DESCENDING)]
+    )
+    await db.study_sessions.create_indexes([session_index])
+    await db.break_sessions.create_indexes([session_index])
+    await db.daily_rollups.create_indexes([
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING)], unique=True)
+    ])
+    await db.daily_activity_rollups.create_indexes([
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING), ("activity", ASCENDING)], unique=True)
+    ])
+
+# Use the rollups once a full backfill has written its marker. A database
+# without any sessions yet needs no backfill.
+async def detect(db):
+    global rollups_enabled
+    if await db.daily_rollups_meta.find_one({"_id": "backfill"}, {"_id": 1}) is None:
+        found = await asyncio.gather(*(
+            collection.find_one({}, {"_id": 1})
+            for collection in (db.study_sessions, db.break_sessions, db.session_buckets)
+        ))
+        if any(doc is not None for doc in found):
+            rollups_enabled = False
+            return
+        await _mark_backfilled(db)
+    rollups_enabled = True
+
+async def _mark_backfilled(db):
+    global rollups_enabled
+    await db.daily_rollups_meta.update_one(
+        {"_id": "backfill"}, {"$set": {"completed_at": datetime.utcnow()}}, upsert=True
+    )
+    rollups_enabled = True
+
+# Fold a just-completed study session into its day's rollup
+async def record_study_rollup(db, session: dict):
+    await db.daily_rollups.bulk_write([study_rollup_update(session)])
+
+# Fold a just-completed break session into its day's rollups
+async def record_break_rollup(db, session: dict):
+    daily, activity = break_rollup_updates(session)
+    await asyncio.gather(
+        db.daily_rollups.bulk_write([daily]),
+        db.daily_activity_rollups.bulk_write([activity])
+    )
+
+# Fold many completed sessions into the rollups with one bulk write per
+# collection (e.g. for a batch of ingested session events)
+async def record_rollups(db, study_sessions: list, break_sessions: list):
+    daily = [study_rollup_update(session) for session in study_sessions]
+    activities = []
+    for session in break_sessions:
+        daily_update, activity_update = break_rollup_updates(session)
+        daily.append(daily_update)
+        activities.append(activity_update)
+    writes = []
+    if daily:
+        writes.append(db.daily_rollups.bulk_write(daily, ordered=False))
+    if activities:
+        writes.append(db.daily_activity_rollups.bulk_write(activities, ordered=False))
+    await asyncio.gather(*writes)
+
+def study_rollup_update(session: dict) -> UpdateOne:
+    return UpdateOne(
+        {"user_id": session["user_id"], "day": day_start(session["start_time"])},
+        {"$inc": {"study_minutes": session_minutes(session), "study_sessions": 1}},
+        upsert=True
+    )
+
+def break_rollup_updates(session: dict) -> tuple:
+    day = day_start(session["start_time"])
+    increments = {"break_minutes": session_minutes(session), "break_sessions": 1}
+    if session.get("energy_level_after") is not None:
+        increments["energy_change_total"] = session["energy_level_after"] - session["energy_level_before"]
+        increments["energy_change_count"] = 1
+    return (
+        UpdateOne({"user_id": session["user_id"], "day": day}, {"$inc": increments}, upsert=True),
+        UpdateOne(
+            {"user_id": session["user_id"], "day": day, "activity": session.get("activity", "")},
+            {"$inc": {"count": 1}},
+            upsert=True
+        ),
+    )
+
+def _session_match(user_id: str, start: datetime, end: datetime = None) -> dict:
+    start_time = {"$gte": start}
+    if end is not None:
+        start_time["$lt"] = end
+    return {"user_id": user_id, "completed": True, "start_time": start_time}
+
+_MINUTES = {"$divide": [{"$subtract": ["$end_time", "$start_time"]}, 60000]}
+_HAS_ENERGY_AFTER = {"$ne": [{"$ifNull": ["$energy_level_after", None]}, None]}
+
+# Totals for completed study sessions in [start, end)
+async def aggregate_study_totals(db, user_id: str, start: datetime, end: datetime = None) -> dict:
+    result = await db.study_sessions.aggregate([
+        {"$match": _session_match(user_id, start, end)},
+        {"$group": {"_id": None, "study_minutes": {"$sum": _MINUTES}, "study_sessions": {"$sum": 1}}}
+    ]).to_list(length=1)
+    return result[0] if result else {}
+
+# Totals and activity counts for completed break sessions in [start, end)
+async def aggregate_break_totals(db, user_id: str, start: datetime, end: datetime = None) -> dict:
+    result = await db.break_sessions.aggregate([
+        {"$match": _session_match(user_id, start, end)},
+        {"$facet": {
+            "totals": [{"$group": {
+                "_id": None,
+                "break_minutes": {"$sum": _MINUTES},
+                "break_sessions": {"$sum": 1},
+                "energy_change_total": {"$sum": {"$cond": [
+                    _HAS_ENERGY_AFTER,
+                    {"$subtract": ["$energy_level_after", "$energy_level_before"]},
+                    0
+                ]}},
+                "energy_change_count": {"$sum": {"$cond": [_HAS_ENERGY_AFTER, 1, 0]}}
+            }}],
+            "activities": [{"$group": {"_id": "$activity", "count": {"$sum": 1}}}]
+        }}
+    ]).to_list(length=1)
+    if not result:
+        return {"activities": {}}
+    totals = result[0]["totals"][0] if result[0]["totals"] else {}
+    totals["activities"] = {doc["_id"]: doc["count"] for doc in result[0]["activities"]}
+    return totals
+
+# Sum the daily rollups for days in [start_day, end_day)
+async def aggregate_rollups(db, user_id: str, start_day: datetime, end_day: datetime = None) -> dict:
+    day = {"$gte": start_day}
+    if end_day is not None:
+        day["$lt"] = end_day
+    match = {"user_id": user_id, "day": day}
+    totals, activities = await asyncio.gather(
+        db.daily_rollups.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": None,
+                "study_minutes": {"$sum": "$study_minutes"},
+                "study_sessions": {"$sum": "$study_sessions"},
+                "break_minutes": {"$sum": "$break_minutes"},
+                "break_sessions": {"$sum": "$break_sessions"},
+                "energy_change_total": {"$sum": "$energy_change_total"},
+                "energy_change_count": {"$sum": "$energy_change_count"}
+            }}
+        ]).to_list(length=1),
+        db.daily_activity_rollups.aggregate([
+            {"$match": match},
+            {"$group": {"_id": "$activity", "count": {"$sum": "$count"}}}
+        ]).to_list(length=None)
+    )
+    result = totals[0] if totals else {}
+    result["activities"] = {doc["_id"]: doc["count"] for doc in activities}
+    return result
+
+def _merge(*parts: dict) -> dict:
+    merged = {"activities": {}}
+    for part in parts:
+        for key, value in part.items():
+            if key == "_id":
+                continue
+            if key == "activities":
+                for activity, count in value.items():
+                    merged["activities"][activity] = merged["activities"].get(activity, 0) + count
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+# Compute the /api/stats payload for the last `days` days
+async def compute_user_stats(db, user_id: str, days: int, now: datetime = None) -> dict:
+    now = now or datetime.utcnow()
+    start_date = now - timedelta(days=days)
+
+    if rollups_enabled and days >= STATS_ROLLUP_MIN_DAYS:
+        # Whole days come from the rollups; only the partial first day is
+        # read from the raw and bucketed sessions
+        first_full_day = day_start(start_date) + timedelta(days=1)
+        end = first_full_day
+        queries = [
+            aggregate_rollups(db, user_id, first_full_day),
+            aggregate_study_totals(db, user_id, start_date, first_full_day),
+            aggregate_break_totals(db, user_id, start_date, first_full_day)
+        ]
+    else:
+        end = None
+        queries = [
+            aggregate_study_totals(db, user_id, start_date),
+            aggregate_break_totals(db, user_id, start_date)
+        ]
+    if buckets.reads_enabled:
+        queries += [
+            buckets.aggregate_totals(db, user_id, "study", start_date, end),
+            buckets.aggregate_totals(db, user_id, "break", start_date, end)
+        ]
+    parts = await asyncio.gather(*queries)
+    totals = _merge(*parts)
+
+    energy_count = totals.get("energy_change_count", 0)
+    activities = sorted(totals["activities"].items(), key=lambda x: x[1], reverse=True)[:5]
+    return {
+        "total_study_time_minutes": totals.get("study_minutes", 0),
+        "total_break_time_minutes": totals.get("break_minutes", 0),
+        "study_sessions_count": totals.get("study_sessions", 0),
+        "break_sessions_count": totals.get("break_sessions", 0),
+        "average_energy_change": totals.get("energy_change_total", 0) / energy_count if energy_count else 0,
+        "most_common_break_activities": activities
+    }
+
+# Rebuild the daily rollups from raw sessions and the day summaries of
+# session buckets. Run once after deploying the rollups (or to repair
+# them); it overwrites rollup documents wholesale. A full run marks the
+# rollups complete.
+async def backfill_daily_rollups(db, user_id: str = None):
+    match = {"completed": True}
+    if user_id is not None:
+        match["user_id"] = user_id
+    day = {"$dateTrunc": {"date": "$start_time", "unit": "day"}}
+
+    study = await db.study_sessions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "day": day},
+            "study_minutes": {"$sum": _MINUTES},
+            "study_sessions": {"$sum": 1}
+        }}
+    ]).to_list(length=None)
+    breaks = await db.break_sessions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "day": day},
+            "break_minutes": {"$sum": _MINUTES},
+            "break_sessions": {"$sum": 1},
+            "energy_change_total": {"$sum": {"$cond": [
+                _HAS_ENERGY_AFTER,
+                {"$subtract": ["$energy_level_after", "$energy_level_before"]},
+                0
+            ]}},
+            "energy_change_count": {"$sum": {"$cond": [_HAS_ENERGY_AFTER, 1, 0]}}
+        }}
+    ]).to_list(length=None)
+    activities = await db.break_sessions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "day": day, "activity": "$activity"},
+            "count": {"$sum": 1}
+        }}
+    ]).to_list(length=None)
+
+    days = [(doc["_id"]["user_id"], doc["_id"]["day"], doc) for doc in study + breaks]
+    activity_counts = {}
+    for doc in activities:
+        key = (doc["_id"]["user_id"], doc["_id"]["day"], doc["_id"]["activity"])
+        activity_counts[key] = doc["count"]
+    async for bucket in db.session_buckets.find(
+        {"user_id": user_id} if user_id is not None else {},
+        {"user_id": 1, "days": 1}
+    ):
+        for summary in bucket["days"]:
+            totals = buckets.day_totals(summary)
+            for activity, count in totals.pop("activities", {}).items():
+                key = (bucket["user_id"], summary["day"], activity)
+                activity_counts[key] = activity_counts.get(key, 0) + count
+            days.append((bucket["user_id"], summary["day"], totals))
+
+    rollups = {}
+    for uid, d, doc in days:
+        values = rollups.setdefault((uid, d), {
+            "study_minutes": 0, "study_sessions": 0,
+            "break_minutes": 0, "break_sessions": 0,
+            "energy_change_total": 0, "energy_change_count": 0
+        })
+        for k, v in doc.items():
+            if k != "_id":
+                values[k] += v
+
+    if user_id is not None:
+        await db.daily_rollups.delete_many({"user_id": user_id})
+        await db.daily_activity_rollups.delete_many({"user_id": user_id})
+    else:
+        await db.daily_rollups.delete_many({})
+        await db.daily_activity_rollups.delete_many({})
+
+    if rollups:
+        await db.daily_rollups.bulk_write([
+            UpdateOne({"user_id": uid, "day": d}, {"$set": values}, upsert=True)
+            for (uid, d), values in rollups.items()
+        ], ordered=False)
+    if activity_counts:
+        await db.daily_activity_rollups.bulk_write([
+            UpdateOne(
+                {"user_id": uid, "day": d, "activity": activity},
+                {"$set": {"count": count}},
+                upsert=True
+            )
+            for (uid, d, activity), count in activity_counts.items()
+        ], ordered=False)
+    if user_id is None:
+        await _mark_backfilled(db)
+
+# Backfill the rollups from the command line: python stats.py
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv("MONGODB_URL"))
+    asyncio.run(backfill_daily_rollups(client.breakbetter))